@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+# Copyright 2022 Christopher J. Kucera
+# <cj@apocalyptech.com>
+# <http://apocalyptech.com/contact.php>
+#
+# PyOakTMS is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# PyOakTMS is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyOakTMS.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import importlib.util
+import subprocess
+import tracemalloc
+import multiprocessing
+
+from oaktms import TMSArchive, peak_rss
+from locres import LocRes, LOCRES_MAGIC, VERSION_COMPACT, _encode_str
+
+# pack-oaktms.py can't be imported by name, thanks to the hyphen
+_pack_spec = importlib.util.spec_from_file_location('pack_oaktms',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pack-oaktms.py'))
+pack_oaktms = importlib.util.module_from_spec(_pack_spec)
+_pack_spec.loader.exec_module(pack_oaktms)
+DataFile = pack_oaktms.DataFile
+
+# Version 2 switched peak memory from tracemalloc to peak RSS
+RESULTS_VERSION = 2
+
+# Memory growth (in bytes) below which we never report a memory regression
+MEMORY_SLACK = 1048576
+
+WORDS = [
+        'Vault', 'Hunter', 'Pandora', 'Sanctuary', 'Claptrap', 'Eridium',
+        'Moxxi', 'Mayhem', 'Loot', 'Legendary', 'Shield', 'Grenade',
+        'Artifact', 'Siren', 'Promethea', 'Eden-6', 'Athenas', 'Nekrotafeyo',
+        'the', 'a', 'of', 'to', 'and', 'with', 'from', 'your', '{0}', '%s',
+        ]
+
+WORDS_NON_ASCII = [
+        'Kammerjäger', 'Übersicht', 'Schlüssel', 'éclair', 'señor',
+        'Тайник', 'охотник', '宝库', '猎人', 'ボールト', 'ハンター', '전설',
+        ]
+
+def random_text(rand, words, non_ascii):
+    """
+    Returns a random run of words.  `non_ascii` is the probability that
+    the text will include at least one non-ASCII word (and therefore be
+    stored as UTF-16 in a .locres file).
+    """
+    text = [rand.choice(words) for _ in range(rand.randint(1, 12))]
+    if rand.random() < non_ascii:
+        text[rand.randrange(len(text))] = rand.choice(WORDS_NON_ASCII)
+    return ' '.join(text)
+
+def write_fstring(df, value):
+    """
+    Writes an engine-style string (signed length, ASCII or UTF-16) to
+    the given `DataFile`
+    """
+    df.write(_encode_str(value))
+
+def write_locres(filename, rand, keys, non_ascii, namespaces=8, duplicates=0.1):
+    """
+    Writes a synthetic version-1 (compact) .locres file with `keys` keys
+    spread over `namespaces` namespaces.  About `duplicates` of the keys
+    share their text with an earlier key, as happens in real files.
+    """
+    strings = []
+    string_idx = {}
+    entries = []
+    for ns_num in range(namespaces):
+        ns_keys = []
+        for key_num in range(ns_num, keys, namespaces):
+            if strings and rand.random() < duplicates:
+                text = rand.choice(strings)
+            else:
+                text = random_text(rand, WORDS, non_ascii)
+            if text not in string_idx:
+                string_idx[text] = len(strings)
+                strings.append(text)
+            ns_keys.append(('KEY_{:06d}'.format(key_num), rand.getrandbits(32), string_idx[text]))
+        entries.append(('Namespace{}'.format(ns_num), ns_keys))
+
+    df = DataFile(filename=filename)
+    df.write(LOCRES_MAGIC)
+    df.write(bytes([VERSION_COMPACT]))
+    table_offset_pos = df.tell()
+    df.ulong64(0)
+    df.uint32(len(entries))
+    for namespace, ns_keys in entries:
+        write_fstring(df, namespace)
+        df.uint32(len(ns_keys))
+        for key, source_hash, idx in ns_keys:
+            write_fstring(df, key)
+            df.uint32(source_hash)
+            df.uint32(idx)
+    table_offset = df.tell()
+    df.uint32(len(strings))
+    for text in strings:
+        write_fstring(df, text)
+    df.seek(table_offset_pos)
+    df.ulong64(table_offset)
+    df.close()
+
+def write_data_file(filename, rand, size):
+    """
+    Writes a synthetic (JSON-ish, and so reasonably compressible) data
+    file of roughly `size` bytes
+    """
+    df = DataFile(filename=filename)
+    written = 0
+    while written < size:
+        line = '{{"{}": "{}"}}\n'.format(rand.choice(WORDS), random_text(rand, WORDS, 0)).encode('utf-8')
+        df.write(line[:size-written])
+        written += len(line)
+    df.close()
+
+def generate_tree(dirname, rand, files, size, locres_fraction, keys, non_ascii):
+    """
+    Generates a synthetic TMS directory tree inside `dirname`, laid out
+    like a real OakTMS file.  Returns a list of the .locres files which
+    were written.
+    """
+    locres_files = []
+    languages = ['de', 'en', 'es', 'fr', 'it', 'ja', 'ko', 'pl', 'pt-BR', 'ru', 'zh-Hans']
+    for idx in range(files):
+        if rand.random() < locres_fraction:
+            lang = languages[idx % len(languages)]
+            path = os.path.join(dirname, 'OakGame', 'Content', 'Localization',
+                    'Game{}'.format(idx // len(languages)), lang, 'Game.locres')
+        else:
+            path = os.path.join(dirname, 'OakGame', 'TMS', 'Data{}'.format(idx % 16),
+                    'data_{:05d}.json'.format(idx))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.endswith('.locres'):
+            write_locres(path, rand, keys, non_ascii)
+            locres_files.append(path)
+        else:
+            write_data_file(path, rand, size)
+    return locres_files
+
+def tree_size(dirname):
+    """
+    Returns the total size of all files inside `dirname`
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(dirname):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+def _proc_status(field):
+    """
+    Returns the given memory field (such as `VmRSS`) from /proc/self/status,
+    in bytes, or `None` if it's not available (ie: we're not on Linux)
+    """
+    try:
+        with open('/proc/self/status') as df:
+            for line in df:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss():
+    """
+    Resets our peak RSS to the current RSS, on Linux, so that whatever we
+    touched while starting up (such as importing modules) doesn't count.
+    Returns the RSS to measure growth from.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as df:
+            df.write('5')
+        return _proc_status('VmRSS')
+    except OSError:
+        return _peak_rss()
+
+def _peak_rss():
+    """
+    Returns the peak RSS of this process, in bytes.  On Linux, this comes
+    from `VmHWM` in /proc, since `ru_maxrss` also counts the peak of the
+    process we were spawned from, from before it exec'd us.
+    """
+    peak = _proc_status('VmHWM')
+    if peak is None:
+        peak = peak_rss()
+    return peak
+
+def _measure_rss_child(func, params, conn):
+    """
+    Runs `func` inside a child process for `measure_memory`, sending back
+    how far our peak RSS rose while it ran (or the error it raised)
+    """
+    try:
+        start = _reset_peak_rss()
+        func(params)
+        conn.send((max(0, _peak_rss() - start), None))
+    except Exception as e:
+        conn.send((None, '{}: {}'.format(type(e).__name__, e)))
+    finally:
+        conn.close()
+
+def measure_memory(func, params):
+    """
+    Runs `func(params)` once and returns its peak memory use, in bytes.
+    Where we can, that's how far the peak RSS of a fresh Python process
+    rises while running it, which (unlike tracemalloc) includes
+    memory-mapped files and buffers allocated by C code like zlib.
+    Otherwise (on Windows), falls back to the peak traced memory.
+    """
+    if peak_rss() is not None:
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_measure_rss_child, args=(func, params, child_conn))
+        process.start()
+        child_conn.close()
+        try:
+            peak, error = parent_conn.recv()
+        except EOFError:
+            peak, error = None, 'benchmark process exited with status {}'.format(process.exitcode)
+        process.join()
+        if error is not None:
+            raise RuntimeError(error)
+        return peak
+    tracemalloc.start()
+    try:
+        func(params)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def measure(func, params, repeat):
+    """
+    Runs `func(params)` `repeat` times and returns the best wall time,
+    followed by the peak memory use (in bytes) of one more run (see
+    `measure_memory`).  Memory is measured separately, so it doesn't affect
+    the timings.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(params)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, measure_memory(func, params)
+
+# The benchmarks themselves.  These live at the top level (and take a dict
+# of parameters) so that they can be run in a separate process when
+# measuring memory.
+
+def bench_pack(params):
+    pack_oaktms.write_tms(params['archive'], params['file_labels'], chunksize=params['chunksize'],
+            footer_strs=['01/01/22 00:00:00', 'bench', 'bench'], jobs=params['jobs'])
+
+def bench_parse(params):
+    TMSArchive(params['archive'], jobs=params['jobs'])
+
+def bench_list(params):
+    for _ in TMSArchive(params['archive'], lazy=True).filenames():
+        pass
+
+def bench_extract(params):
+    extract_dir = params['extract_dir']
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    for filename, data in TMSArchive(params['archive'], stream=True, jobs=params['jobs']):
+        full_filename = os.path.join(extract_dir, filename)
+        os.makedirs(os.path.dirname(full_filename), exist_ok=True)
+        with open(full_filename, 'wb') as odf:
+            odf.write(data)
+
+def bench_locres(params):
+    for filename in params['locres_files']:
+        with LocRes(filename) as locres:
+            for idx in range(len(locres)):
+                locres.line(idx)
+
+def git_commit():
+    """
+    Returns the current git commit of the checkout we're running from, if
+    we can find it.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(workdir, args):
+    """
+    Generates our synthetic data inside `workdir` and runs each of the
+    benchmarks over it.  Returns a dict of results, keyed by benchmark name.
+    """
+    rand = random.Random(args.seed)
+    tree_dir = os.path.join(workdir, 'tree')
+    archive = os.path.join(workdir, 'bench.cfg')
+    extract_dir = os.path.join(workdir, 'extract')
+
+    print('Generating {} files in {}'.format(args.files, tree_dir))
+    locres_files = generate_tree(tree_dir, rand, args.files, args.size,
+            args.locres_fraction, args.keys, args.non_ascii)
+    filelist = []
+    for dirpath, _, filenames in os.walk(tree_dir):
+        for filename in filenames:
+            filelist.append(os.path.join(dirpath, filename))
+    filelist.sort(key=pack_oaktms.tms_sort)
+    file_labels = pack_oaktms.get_file_labels(tree_dir, filelist, '../../..')
+    data_size = tree_size(tree_dir)
+    locres_size = sum(os.path.getsize(f) for f in locres_files)
+
+    params = {
+            'archive': archive,
+            'file_labels': file_labels,
+            'chunksize': args.chunksize,
+            'jobs': args.jobs,
+            'extract_dir': extract_dir,
+            'locres_files': locres_files,
+            }
+
+    # Packing has to come first, since everything else reads its output
+    benchmarks = [
+            ('pack', bench_pack, data_size),
+            ('parse', bench_parse, data_size),
+            ('list', bench_list, data_size),
+            ('extract', bench_extract, data_size),
+            ('locres', bench_locres, locres_size),
+            ]
+    results = {}
+    for name, func, size in benchmarks:
+        if name == 'locres' and not locres_files:
+            continue
+        seconds, peak = measure(func, params, args.repeat)
+        results[name] = {
+                'seconds': seconds,
+                'bytes': size,
+                'mb_per_sec': size / seconds / 1048576 if seconds else None,
+                'peak_memory': peak,
+                }
+        print('{:>8}: {:8.3f}s  {:8.1f} MB/s  {:8.1f} MB peak'.format(
+            name, seconds, results[name]['mb_per_sec'] or 0, peak / 1048576))
+    results['pack']['archive_size'] = os.path.getsize(archive)
+    return results
+
+def compare(old, new, threshold, memory_threshold):
+    """
+    Prints a comparison of two sets of benchmark results, and returns the
+    names of any benchmarks which got slower by more than `threshold`
+    percent, or whose peak memory use grew by more than `memory_threshold`
+    percent (and at least `MEMORY_SLACK` bytes, so that benchmarks which
+    barely use any memory don't trip over noise).
+    """
+    if old.get('params') != new.get('params'):
+        print('WARNING: benchmark parameters differ between runs')
+    compare_memory = old.get('version') == new['version']
+    if not compare_memory:
+        print('WARNING: baseline measured memory differently, so only times will be compared')
+    regressions = []
+    print('{:>8}  {:>9}  {:>9}  {:>7}  {:>9}  {:>9}  {:>7}'.format(
+        '', 'old', 'new', 'change', 'old mem', 'new mem', 'change'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        old_seconds = old['results'][name]['seconds']
+        change = (result['seconds'] - old_seconds) / old_seconds * 100
+        flags = []
+        if change > threshold:
+            flags.append('time')
+        old_peak = old['results'][name]['peak_memory']
+        new_peak = result['peak_memory']
+        if old_peak:
+            mem_change = (new_peak - old_peak) / old_peak * 100
+        else:
+            mem_change = 0 if not new_peak else float('inf')
+        if compare_memory and mem_change > memory_threshold and new_peak - old_peak > MEMORY_SLACK:
+            flags.append('memory')
+        if flags:
+            regressions.append(name)
+        print('{:>8}: {:8.3f}s  {:8.3f}s  {:+6.1f}%  {:7.1f}MB  {:7.1f}MB  {:+6.1f}%{}'.format(
+            name, old_seconds, result['seconds'], change,
+            old_peak / 1048576, new_peak / 1048576, mem_change,
+            '  <-- {} regression'.format(' and '.join(flags)) if flags else ''))
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark OakTMS/locres processing on synthetic data',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+
+    parser.add_argument('-n', '--files',
+            type=int,
+            default=500,
+            help='Number of files to generate',
+            )
+
+    parser.add_argument('--size',
+            type=int,
+            default=16384,
+            help='Size of each generated data file, in bytes',
+            )
+
+    parser.add_argument('--locres-fraction',
+            type=float,
+            default=0.5,
+            help='Fraction of generated files which are .locres files',
+            )
+
+    parser.add_argument('--keys',
+            type=int,
+            default=500,
+            help='Number of keys in each generated .locres file',
+            )
+
+    parser.add_argument('--non-ascii',
+            type=float,
+            default=0.2,
+            help='Fraction of .locres strings which contain non-ASCII characters',
+            )
+
+    parser.add_argument('-c', '--chunksize',
+            type=int,
+            default=131072,
+            help='Chunk size to use in the generated TMS file',
+            )
+
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of threads to use while compressing/decompressing',
+            )
+
+    parser.add_argument('-r', '--repeat',
+            type=int,
+            default=3,
+            help='Number of times to run each benchmark (the best time is reported)',
+            )
+
+    parser.add_argument('--seed',
+            type=int,
+            default=0,
+            help='Random seed for the generated data',
+            )
+
+    parser.add_argument('-w', '--workdir',
+            help='Directory to generate data in (defaults to a temporary directory)',
+            )
+
+    parser.add_argument('-o', '--output',
+            help='JSON file to write results to',
+            )
+
+    parser.add_argument('--compare',
+            metavar='BASELINE',
+            help='Compare results against a previous JSON results file',
+            )
+
+    parser.add_argument('--threshold',
+            type=float,
+            default=10,
+            help='Percentage slowdown which counts as a regression when comparing',
+            )
+
+    parser.add_argument('--memory-threshold',
+            type=float,
+            default=10,
+            help='Percentage growth in peak memory which counts as a regression when comparing',
+            )
+
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        if not os.path.exists(args.compare):
+            print('ERROR: {} does not exist'.format(args.compare))
+            sys.exit(1)
+        with open(args.compare) as df:
+            baseline = json.load(df)
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args.workdir, args)
+    else:
+        with tempfile.TemporaryDirectory(prefix='bench-oaktms-') as workdir:
+            results = run_benchmarks(workdir, args)
+
+    report = {
+            'version': RESULTS_VERSION,
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {
+                'files': args.files,
+                'size': args.size,
+                'locres_fraction': args.locres_fraction,
+                'keys': args.keys,
+                'non_ascii': args.non_ascii,
+                'chunksize': args.chunksize,
+                'jobs': args.jobs,
+                'repeat': args.repeat,
+                'seed': args.seed,
+                },
+            'results': results,
+            }
+    if args.output:
+        with open(args.output, 'w') as odf:
+            json.dump(report, odf, indent=2)
+        print('Wrote results to {}'.format(args.output))
+
+    if baseline is not None:
+        print('')
+        regressions = compare(baseline, report, args.threshold, args.memory_threshold)
+        if regressions:
+            print('Regressions found in: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -18,18 +18,33 @@
 # You should have received a copy of the GNU General Public License
 # along with PyOakTMS.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
+import os
+import re
 import sys
+import json
+import zlib
+import mmap
+import array
+import bisect
+import hashlib
+import collections
 import struct
+import sqlite3
+import atexit
 import argparse
+import contextlib
+import concurrent.futures
 
 # Credits to https://github.com/klimaleksus/UE4-locres-Online-Editor for
 # having already figured this out!
 
 # This app isn't especially nicely put together, sorry for the excess
-# of mess and scoping violations!  Also doesn't really fully parse the
-# header; this implementation might fail in some circumstances (it
-# works for the BL3 .locres files that I've tried, though, so that's
-# good enough for me).
+# of mess and scoping violations!  The original `Namespace`/`Key` classes
+# don't really parse the header; that implementation might fail in some
+# circumstances (it works for the BL3 .locres files that I've tried,
+# though, so that's good enough for me).  The `LocRes` class understands
+# the header versions that the engine knows about.
 
 def _uint32(df):
     return struct.unpack('<I', df.read(4))[0]
@@ -49,6 +64,68 @@ def _str(df):
     else:
         return df.read(abs(strlen)*2)[:-2].decode('utf-16le')
 
+_INT32 = struct.Struct('<i')
+_UINT32 = struct.Struct('<I')
+_INT64 = struct.Struct('<q')
+_KEY_INFO = struct.Struct('<Ii')
+
+# .locres header magic, and the format versions we know about.  Legacy
+# files have no header at all, and store each key's string inline.
+# Optimized versions store hashes for each namespace and key (CRC32 for
+# version 2, CityHash64 for version 3), plus a refcount for each string.
+LOCRES_MAGIC = bytes.fromhex('0e147475674a03fc4a15909de1377f1b')
+VERSION_LEGACY = 0
+VERSION_COMPACT = 1
+VERSION_OPTIMIZED_CRC32 = 2
+VERSION_OPTIMIZED_CITYHASH64 = 3
+
+def _encode_str(value):
+    """
+    Encodes a string the way the engine would store it: pure-ASCII strings
+    are stored as single-byte characters with a positive length, and anything
+    else as UTF-16 with a negative length.  Both are null-terminated.
+    """
+    if value == '':
+        return _INT32.pack(0)
+    try:
+        bytes_val = value.encode('ascii') + b"\00"
+        return _INT32.pack(len(bytes_val)) + bytes_val
+    except UnicodeEncodeError:
+        bytes_val = value.encode('utf-16le') + b"\00\00"
+        return _INT32.pack(-(len(bytes_val)//2)) + bytes_val
+
+def str_crc32(value):
+    """
+    Computes the engine's `FCrc::StrCrc32` hash of a string, as stored for
+    namespaces and keys in version-2 .locres files.  That's a regular CRC32
+    over each UTF-16 code unit widened to four bytes.
+    """
+    units = value.encode('utf-16le')
+    return zlib.crc32(struct.pack('<{}I'.format(len(units)//2), *struct.unpack('<{}H'.format(len(units)//2), units)))
+
+def _str_at(buf, pos):
+    """
+    Decodes the string at the given position in `buf`
+    """
+    strlen = _INT32.unpack_from(buf, pos)[0]
+    if strlen == 0:
+        return ''
+    elif strlen > 0:
+        return str(buf[pos+4:pos+3+strlen], 'utf-8')
+    else:
+        return str(buf[pos+4:pos+2+abs(strlen)*2], 'utf-16le')
+
+def _skip_str(buf, pos):
+    """
+    Returns the position just after the string at the given position in
+    `buf`, without decoding it
+    """
+    strlen = _INT32.unpack_from(buf, pos)[0]
+    if strlen >= 0:
+        return pos + 4 + strlen
+    else:
+        return pos + 4 + abs(strlen)*2
+
 class Key:
 
     def __init__(self, namespace, df):
@@ -70,38 +147,953 @@ class Namespace:
         for _ in range(num_keys):
             self.keys.append(Key(self, df))
 
+class LocRes:
+    """
+    Faster .locres parser.  The file is memory-mapped and walked with
+    `struct.unpack_from`, and rather than building a `Key` object for
+    every key, we just record where everything lives in a handful of
+    arrays.  Namespace names, keys, and strings are only decoded when
+    they're asked for.
+
+    Keys are numbered sequentially through the whole file, and the keys
+    for namespace `n` are `range(ns_key_starts[n], ns_key_starts[n+1])`.
+    `source_hashes` holds the hash of each key's source string (the
+    `idnum` of the original `Key` class).  For optimized-format files,
+    `ns_hashes` and `key_hashes` hold the stored namespace and key hashes
+    (otherwise they'll be all zeroes).
+    """
+
+    def __init__(self, filename, stats=None):
+        """
+        `filename` may be a path to a .locres file (which will be memory-
+        mapped), the .locres data itself (as `bytes`, a `bytearray`, or a
+        `memoryview`, which will be used without copying), or a binary
+        file-like object (which will be read in).
+
+        If `stats` is passed in, it should be an `oaktms.Stats` object,
+        which will be updated with timings for each phase of parsing.
+
+        Raises a `RuntimeError` if the data isn't a valid .locres file.
+        """
+        self.filename = None
+        self.version = None
+        self.ns_offsets = array.array('Q')
+        self.ns_hashes = array.array('I')
+        self.ns_key_starts = array.array('Q')
+        self.key_offsets = array.array('Q')
+        self.key_hashes = array.array('I')
+        self.source_hashes = array.array('I')
+        self.key_string_idx = array.array('i')
+        self.inline_strings = {}
+        self.string_offsets = array.array('Q')
+        self._mmap = None
+        self.buf = None
+        self.stats = stats
+        self._lookup = None
+        try:
+            with self._phase('open') as phase:
+                if isinstance(filename, (str, os.PathLike)):
+                    self.filename = os.fspath(filename)
+                    with open(self.filename, 'rb') as df:
+                        # (mmap refuses empty files, which raises a ValueError)
+                        self._mmap = mmap.mmap(df.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.buf = memoryview(self._mmap)
+                elif isinstance(filename, (bytes, bytearray, memoryview)):
+                    self.buf = memoryview(filename)
+                else:
+                    self.buf = memoryview(filename.read())
+                phase['bytes'] = len(self.buf)
+            self._parse()
+        except (struct.error, IndexError, ValueError) as e:
+            self.close()
+            raise RuntimeError('Malformed .locres data: {}'.format(e)) from e
+        except Exception:
+            self.close()
+            raise
+
+    def _phase(self, name, nbytes=0):
+        """
+        Returns a context manager which times the enclosed code as part of
+        the named phase, if we're collecting stats (see `oaktms.Stats.phase`)
+        """
+        if self.stats is None:
+            return contextlib.nullcontext({})
+        return self.stats.phase(name, nbytes)
+
+    def _parse(self):
+        buf = self.buf
+
+        # Header
+        with self._phase('header') as phase:
+            string_table_offset = None
+            if bytes(buf[:16]) == LOCRES_MAGIC:
+                self.version = buf[16]
+                if self.version > VERSION_OPTIMIZED_CITYHASH64:
+                    raise RuntimeError('Unknown .locres version: {}'.format(self.version))
+                string_table_offset = _INT64.unpack_from(buf, 17)[0]
+                pos = 25
+                if self.version >= VERSION_OPTIMIZED_CRC32:
+                    # Total entry count, which we don't need
+                    pos += 4
+            else:
+                self.version = VERSION_LEGACY
+                pos = 0
+            hashed = self.version >= VERSION_OPTIMIZED_CRC32
+            phase['bytes'] = pos
+
+        # Namespaces and keys
+        with self._phase('entries') as phase:
+            entries_start = pos
+            namespace_count = _UINT32.unpack_from(buf, pos)[0]
+            pos += 4
+            for _ in range(namespace_count):
+                if hashed:
+                    self.ns_hashes.append(_UINT32.unpack_from(buf, pos)[0])
+                    pos += 4
+                else:
+                    self.ns_hashes.append(0)
+                self.ns_offsets.append(pos)
+                self.ns_key_starts.append(len(self.key_offsets))
+                pos = _skip_str(buf, pos)
+                num_keys = _UINT32.unpack_from(buf, pos)[0]
+                pos += 4
+                for _ in range(num_keys):
+                    if hashed:
+                        self.key_hashes.append(_UINT32.unpack_from(buf, pos)[0])
+                        pos += 4
+                    else:
+                        self.key_hashes.append(0)
+                    self.key_offsets.append(pos)
+                    pos = _skip_str(buf, pos)
+                    if self.version == VERSION_LEGACY:
+                        self.source_hashes.append(_UINT32.unpack_from(buf, pos)[0])
+                        pos += 4
+                        self.inline_strings[len(self.key_string_idx)] = pos
+                        pos = _skip_str(buf, pos)
+                        self.key_string_idx.append(-1)
+                        continue
+                    idnum, number = _KEY_INFO.unpack_from(buf, pos)
+                    pos += 8
+                    self.source_hashes.append(idnum)
+                    if number < 0 and not hashed:
+                        # Carried over from the original parser
+                        self.inline_strings[len(self.key_string_idx)] = pos
+                        pos = _skip_str(buf, pos)
+                        number = -1
+                    self.key_string_idx.append(number)
+            self.ns_key_starts.append(len(self.key_offsets))
+            phase['bytes'] = pos - entries_start
+
+        # String table
+        if string_table_offset is None:
+            return
+        with self._phase('strings') as phase:
+            pos = string_table_offset
+            string_count = _UINT32.unpack_from(buf, pos)[0]
+            pos += 4
+            for _ in range(string_count):
+                self.string_offsets.append(pos)
+                pos = _skip_str(buf, pos)
+                if hashed:
+                    # Refcount
+                    pos += 4
+            phase['bytes'] = pos - string_table_offset
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.release()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.key_offsets)
+
+    def namespace_count(self):
+        return len(self.ns_offsets)
+
+    def namespace(self, ns_idx):
+        """
+        Returns the name of the specified namespace
+        """
+        return _str_at(self.buf, self.ns_offsets[ns_idx])
+
+    def namespace_keys(self, ns_idx):
+        """
+        Returns a range of the key indexes in the specified namespace
+        """
+        return range(self.ns_key_starts[ns_idx], self.ns_key_starts[ns_idx+1])
+
+    def key(self, key_idx):
+        """
+        Returns the name of the specified key
+        """
+        return _str_at(self.buf, self.key_offsets[key_idx])
+
+    def string(self, string_idx):
+        """
+        Returns the specified entry from the string table
+        """
+        return _str_at(self.buf, self.string_offsets[string_idx])
+
+    def line(self, key_idx):
+        """
+        Returns the string for the specified key
+        """
+        if key_idx in self.inline_strings:
+            return _str_at(self.buf, self.inline_strings[key_idx])
+        return self.string(self.key_string_idx[key_idx])
+
+    def _raw_str(self, pos):
+        """
+        Returns the raw (encoded, length-prefixed) bytes of the string at
+        the given position, without decoding it
+        """
+        return bytes(self.buf[pos:_skip_str(self.buf, pos)])
+
+    def _raw_line(self, key_idx):
+        """
+        Returns the raw (encoded) string for the specified key, without
+        decoding it
+        """
+        if key_idx in self.inline_strings:
+            return self._raw_str(self.inline_strings[key_idx])
+        return self._raw_str(self.string_offsets[self.key_string_idx[key_idx]])
+
+    def raw_key_map(self):
+        """
+        Returns a dict mapping a tuple of the raw (encoded) namespace and key
+        to the index of each key, without decoding anything
+        """
+        raw_keys = {}
+        for ns_idx in range(self.namespace_count()):
+            raw_ns = self._raw_str(self.ns_offsets[ns_idx])
+            for key_idx in self.namespace_keys(ns_idx):
+                raw_keys[(raw_ns, self._raw_str(self.key_offsets[key_idx]))] = key_idx
+        return raw_keys
+
+    def _build_lookup(self):
+        """
+        Builds our namespace+key lookup table.  For version-2 files, this is
+        keyed on the namespace and key hashes stored in the file, so nothing
+        needs to be read besides those.  Otherwise (including version 3,
+        since we don't implement CityHash64), it's keyed on the raw encoded
+        namespace and key.  Either way, no strings get decoded.  The table
+        is only put in place once it's complete, so lookups from other
+        threads never see it half-built.
+        """
+        lookup = {}
+        for ns_idx in range(self.namespace_count()):
+            if self.version == VERSION_OPTIMIZED_CRC32:
+                ns_id = self.ns_hashes[ns_idx]
+            else:
+                ns_id = self._raw_str(self.ns_offsets[ns_idx])
+            for key_idx in self.namespace_keys(ns_idx):
+                if self.version == VERSION_OPTIMIZED_CRC32:
+                    key_id = self.key_hashes[key_idx]
+                else:
+                    key_id = self._raw_str(self.key_offsets[key_idx])
+                lookup.setdefault((ns_id, key_id), []).append(key_idx)
+        self._lookup = lookup
+
+    def find(self, namespace, key):
+        """
+        Returns the index of the specified key in the specified namespace,
+        or raises a `KeyError` if it can't be found.  The lookup table gets
+        built the first time this is called.
+        """
+        if self._lookup is None:
+            self._build_lookup()
+        encoded_ns = _encode_str(namespace)
+        encoded_key = _encode_str(key)
+        if self.version == VERSION_OPTIMIZED_CRC32:
+            lookup_id = (str_crc32(namespace), str_crc32(key))
+        else:
+            lookup_id = (encoded_ns, encoded_key)
+        for key_idx in self._lookup.get(lookup_id, []):
+            # If we looked up by hash, make sure we don't have a collision
+            ns_idx = bisect.bisect_right(self.ns_key_starts, key_idx) - 1
+            if self._raw_str(self.key_offsets[key_idx]) == encoded_key \
+                    and self._raw_str(self.ns_offsets[ns_idx]) == encoded_ns:
+                return key_idx
+        raise KeyError((namespace, key))
+
+    def get(self, namespace, key):
+        """
+        Returns the string for the specified key in the specified namespace,
+        or raises a `KeyError` if it can't be found.
+        """
+        return self.line(self.find(namespace, key))
+
+    def encode(self, edits=None):
+        """
+        Returns the .locres data for this file, in the same format version,
+        with the strings for the keys in `edits` (a dict mapping a tuple of
+        namespace and key to the new string) replaced.  Everything else,
+        including hashes and string refcounts, is carried over as-is, so a
+        file with no edits comes out byte-for-byte identical.  New strings
+        are added to the end of the string table (unless they're already
+        in it).  Raises a `KeyError` if an edited key doesn't exist.
+        """
+        buf = self.buf
+        hashed = self.version >= VERSION_OPTIMIZED_CRC32
+        new_lines = {}
+        if edits:
+            for (namespace, key), text in edits.items():
+                new_lines[self.find(namespace, key)] = _encode_str(text)
+
+        # String table, with refcounts for the optimized formats
+        strings = [self._raw_str(pos) for pos in self.string_offsets]
+        refcounts = []
+        if hashed:
+            refcounts = [_INT32.unpack_from(buf, _skip_str(buf, pos))[0] for pos in self.string_offsets]
+        string_lookup = {}
+        for string_idx, raw in enumerate(strings):
+            string_lookup.setdefault(raw, string_idx)
+
+        # Apply our edits
+        key_string_idx = array.array('i', self.key_string_idx)
+        inline = {}
+        for key_idx, raw in new_lines.items():
+            if key_idx in self.inline_strings:
+                inline[key_idx] = raw
+                continue
+            if hashed:
+                refcounts[key_string_idx[key_idx]] -= 1
+            if raw not in string_lookup:
+                string_lookup[raw] = len(strings)
+                strings.append(raw)
+                refcounts.append(0)
+            key_string_idx[key_idx] = string_lookup[raw]
+            if hashed:
+                refcounts[key_string_idx[key_idx]] += 1
+
+        # Header
+        out = io.BytesIO()
+        if self.version != VERSION_LEGACY:
+            out.write(bytes(buf[:25]))
+            if hashed:
+                out.write(bytes(buf[25:29]))
+
+        # Namespaces and keys
+        out.write(_UINT32.pack(self.namespace_count()))
+        for ns_idx in range(self.namespace_count()):
+            if hashed:
+                out.write(_UINT32.pack(self.ns_hashes[ns_idx]))
+            out.write(self._raw_str(self.ns_offsets[ns_idx]))
+            keys = self.namespace_keys(ns_idx)
+            out.write(_UINT32.pack(len(keys)))
+            for key_idx in keys:
+                if hashed:
+                    out.write(_UINT32.pack(self.key_hashes[key_idx]))
+                out.write(self._raw_str(self.key_offsets[key_idx]))
+                out.write(_UINT32.pack(self.source_hashes[key_idx]))
+                if key_idx in self.inline_strings:
+                    if self.version != VERSION_LEGACY:
+                        out.write(_INT32.pack(-1))
+                    if key_idx in inline:
+                        out.write(inline[key_idx])
+                    else:
+                        out.write(self._raw_str(self.inline_strings[key_idx]))
+                else:
+                    out.write(_INT32.pack(key_string_idx[key_idx]))
+
+        # String table, and backpatch its offset into the header
+        if self.version != VERSION_LEGACY:
+            string_table_offset = out.tell()
+            out.write(_UINT32.pack(len(strings)))
+            for string_idx, raw in enumerate(strings):
+                out.write(raw)
+                if hashed:
+                    out.write(_INT32.pack(refcounts[string_idx]))
+            out.seek(17)
+            out.write(_INT64.pack(string_table_offset))
+
+        return out.getvalue()
+
+def iter_archive_locres(archive, include=None, jobs=1, stats=None):
+    """
+    Yields a tuple of the filename and a parsed `LocRes` for each `.locres`
+    file inside the given OakTMS/DaffodilTMS archive, parsed straight from
+    the decompressed archive data without touching the disk.  `archive` may
+    be anything that `TMSArchive` accepts, or an already-opened `TMSArchive`.
+    `include` may be a list of glob patterns to further restrict which
+    `.locres` files are parsed (see `oaktms.PathTrie.match`).  `stats` may
+    be an `oaktms.Stats` object to collect timings in.
+    """
+    from oaktms import TMSArchive
+    if not isinstance(archive, TMSArchive):
+        archive = TMSArchive(archive, jobs=jobs, stats=stats)
+    locres_files = set(archive.select(['*.locres']))
+    if include:
+        locres_files &= set(archive.select(include))
+    for filename, contents in archive.iter_files(sorted(locres_files)):
+        yield (filename, LocRes(contents, stats=stats))
+
+def iter_locres_sources(filename, archive=False, include=None, jobs=1, stats=None):
+    """
+    Yields a tuple of a name and data for each `.locres` file to be found at
+    `filename`, which may be a directory (which will be searched for
+    `.locres` files), a TMS archive (if `archive` is `True`), or a single
+    `.locres` file.  The data will be `None` for files on disk (in which
+    case the name is the path to the file), and the raw `.locres` data for
+    files inside an archive.  `stats` may be an `oaktms.Stats` object to
+    collect archive timings in.
+    """
+    if os.path.isdir(filename):
+        for dirpath, _, filenames in os.walk(filename):
+            for locres_filename in sorted(filenames):
+                if locres_filename.endswith('.locres'):
+                    yield (os.path.join(dirpath, locres_filename), None)
+    elif archive:
+        from oaktms import TMSArchive
+        tms = TMSArchive(filename, jobs=jobs, stats=stats)
+        locres_files = set(tms.select(['*.locres']))
+        if include:
+            locres_files &= set(tms.select(include))
+        for locres_filename, contents in tms.iter_files(sorted(locres_files)):
+            yield (locres_filename, contents)
+    else:
+        yield (filename, None)
+
+def locres_language(filename):
+    """
+    Returns the language of a `.locres` file, given its path (which is just
+    the name of the directory that it's in)
+    """
+    parts = filename.replace('\\', '/').split('/')
+    if len(parts) > 1:
+        return parts[-2]
+    return ''
+
+def locres_rows(filename, locres):
+    """
+    Yields a row for every key in the given `LocRes`: a tuple of the
+    filename, language, namespace, key, source string hash, and string.
+    """
+    language = locres_language(filename)
+    for ns_idx in range(locres.namespace_count()):
+        namespace = locres.namespace(ns_idx)
+        for key_idx in locres.namespace_keys(ns_idx):
+            yield (filename,
+                    language,
+                    namespace,
+                    locres.key(key_idx),
+                    locres.source_hashes[key_idx],
+                    locres.line(key_idx),
+                    )
+
+def _export_worker(filename, data):
+    """
+    Parses a single `.locres` file in an export worker process, and returns
+    a list of its rows
+    """
+    with LocRes(filename if data is None else data) as locres:
+        return list(locres_rows(filename, locres))
+
+EXPORT_COLUMNS = ['filename', 'language', 'namespace', 'key', 'source_hash', 'text']
+
+def export_locres(sources, output, jobs=1):
+    """
+    Exports every key from the given `.locres` sources (as yielded by
+    `iter_locres_sources`) to `output`, which will be written as JSON Lines
+    if it ends in `.jsonl`, or as a SQLite database (with a `strings`
+    table) otherwise.  Any existing export will be replaced.  Files are
+    parsed in a pool of `jobs` worker processes, and each file's rows are
+    written out in a single batch.  Returns the number of rows written.
+    """
+    if output.endswith('.jsonl'):
+        odf = open(output, 'w', encoding='utf-8')
+        def write_rows(rows):
+            odf.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows)
+        finish = odf.close
+    else:
+        db = sqlite3.connect(output)
+        db.execute('DROP TABLE IF EXISTS strings')
+        db.execute('CREATE TABLE strings ({})'.format(', '.join(EXPORT_COLUMNS)))
+        insert = 'INSERT INTO strings VALUES ({})'.format(', '.join(['?']*len(EXPORT_COLUMNS)))
+        def write_rows(rows):
+            db.executemany(insert, rows)
+        def finish():
+            db.commit()
+            db.close()
+
+    # Keep a bounded number of files in flight, so we don't end up with
+    # every file from an archive waiting around in memory at once.
+    num_rows = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        pending = collections.deque()
+        for filename, data in sources:
+            if data is not None:
+                data = bytes(data)
+            pending.append(executor.submit(_export_worker, filename, data))
+            while len(pending) > jobs*2 or (pending and pending[0].done()):
+                rows = pending.popleft().result()
+                write_rows(rows)
+                num_rows += len(rows)
+        while pending:
+            rows = pending.popleft().result()
+            write_rows(rows)
+            num_rows += len(rows)
+    finish()
+    return num_rows
+
+class SearchIndex:
+    """
+    Persistent full-text index of localization strings, stored in a SQLite
+    database.  Each string is split into lowercase word tokens, and the
+    `postings` table maps each token to the strings which contain it.
+
+    Strings are grouped by "source" (an archive or directory label) and
+    `.locres` filename.  When a source is updated, only the `.locres` files
+    whose contents have changed get re-indexed.
+    """
+
+    TOKEN_RE = re.compile(r'\w+')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                UNIQUE (source, filename)
+                );
+            CREATE TABLE IF NOT EXISTS strings (
+                id INTEGER PRIMARY KEY,
+                file_id INTEGER NOT NULL,
+                language TEXT NOT NULL,
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                text TEXT NOT NULL
+                );
+            CREATE INDEX IF NOT EXISTS strings_file ON strings (file_id);
+            CREATE TABLE IF NOT EXISTS postings (
+                token TEXT NOT NULL,
+                string_id INTEGER NOT NULL,
+                PRIMARY KEY (token, string_id)
+                ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_string ON postings (string_id);
+            """)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def tokenize(self, text):
+        """
+        Returns the set of search tokens found in the given text
+        """
+        return set(token.lower() for token in self.TOKEN_RE.findall(text))
+
+    def _remove_file(self, file_id):
+        """
+        Removes all strings (and their postings) for the given file ID
+        """
+        self.db.execute('DELETE FROM postings WHERE string_id IN (SELECT id FROM strings WHERE file_id=?)', (file_id,))
+        self.db.execute('DELETE FROM strings WHERE file_id=?', (file_id,))
+
+    def update(self, source, locres_sources):
+        """
+        Updates the index for the given source label with the `.locres`
+        files in `locres_sources` (as yielded by `iter_locres_sources`).
+        Files which are unchanged since the last update are skipped, and
+        files which are no longer present are removed.  Returns a Counter
+        of how many files were `added`, `changed`, `unchanged`, and
+        `removed`.
+        """
+        counts = collections.Counter()
+        existing = {}
+        for file_id, filename, digest in self.db.execute('SELECT id, filename, digest FROM files WHERE source=?', (source,)):
+            existing[filename] = (file_id, digest)
+
+        with self.db:
+            seen = set()
+            for filename, data in locres_sources:
+                if data is None:
+                    with open(filename, 'rb') as df:
+                        data = df.read()
+                seen.add(filename)
+                digest = hashlib.sha1(data).hexdigest()
+                if filename in existing:
+                    file_id, old_digest = existing[filename]
+                    if old_digest == digest:
+                        counts['unchanged'] += 1
+                        continue
+                    self._remove_file(file_id)
+                    self.db.execute('UPDATE files SET digest=? WHERE id=?', (digest, file_id))
+                    counts['changed'] += 1
+                else:
+                    file_id = self.db.execute('INSERT INTO files (source, filename, digest) VALUES (?, ?, ?)',
+                            (source, filename, digest)).lastrowid
+                    counts['added'] += 1
+
+                with LocRes(data) as locres:
+                    for _, language, namespace, key, _, text in locres_rows(filename, locres):
+                        string_id = self.db.execute('INSERT INTO strings (file_id, language, namespace, key, text) VALUES (?, ?, ?, ?, ?)',
+                                (file_id, language, namespace, key, text)).lastrowid
+                        self.db.executemany('INSERT INTO postings (token, string_id) VALUES (?, ?)',
+                                [(token, string_id) for token in self.tokenize(text)])
+
+            for filename, (file_id, _) in existing.items():
+                if filename not in seen:
+                    self._remove_file(file_id)
+                    self.db.execute('DELETE FROM files WHERE id=?', (file_id,))
+                    counts['removed'] += 1
+
+        return counts
+
+    def search(self, query, limit=None):
+        """
+        Returns a list of strings which contain every token in `query`, as
+        tuples of the source, filename, language, namespace, key, and text.
+        """
+        tokens = self.tokenize(query)
+        if not tokens:
+            return []
+        subquery = ' INTERSECT '.join(['SELECT string_id FROM postings WHERE token=?']*len(tokens))
+        sql = """SELECT f.source, f.filename, s.language, s.namespace, s.key, s.text
+            FROM strings s JOIN files f ON f.id = s.file_id
+            WHERE s.id IN ({})
+            ORDER BY f.source, f.filename, s.id""".format(subquery)
+        params = list(tokens)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return self.db.execute(sql, params).fetchall()
+
+def diff_locres(old, new):
+    """
+    Compares two `LocRes` objects, returning a list of the namespaces which
+    differ between them, as tuples of the namespace name and lists of added
+    keys, removed keys, and changed keys.  Added and removed keys are tuples
+    of the key and its string, and changed keys are tuples of the key, the
+    old string, and the new string.
+
+    Keys are matched on their raw encoded namespace and key, and compared
+    using their stored source string hashes and raw string data, so only
+    the keys and strings which actually differ get decoded.
+    """
+    old_keys = old.raw_key_map()
+    new_keys = new.raw_key_map()
+    namespaces = {}
+    for raw_id, new_idx in new_keys.items():
+        old_idx = old_keys.get(raw_id)
+        if old_idx is None:
+            added, _, _ = namespaces.setdefault(raw_id[0], ([], [], []))
+            added.append((new.key(new_idx), new.line(new_idx)))
+        elif old.source_hashes[old_idx] != new.source_hashes[new_idx] \
+                or old._raw_line(old_idx) != new._raw_line(new_idx):
+            _, _, changed = namespaces.setdefault(raw_id[0], ([], [], []))
+            changed.append((new.key(new_idx), old.line(old_idx), new.line(new_idx)))
+    for raw_id, old_idx in old_keys.items():
+        if raw_id not in new_keys:
+            _, removed, _ = namespaces.setdefault(raw_id[0], ([], [], []))
+            removed.append((old.key(old_idx), old.line(old_idx)))
+    return [(_str_at(raw_ns, 0), added, removed, changed) for raw_ns, (added, removed, changed) in namespaces.items()]
+
+def diff_archive_locres(old_archive, new_archive, include=None, jobs=1, stats=None):
+    """
+    Compares the `.locres` files in two TMS archives (anything `TMSArchive`
+    accepts).  `.locres` files which are identical in both archives are
+    skipped without being parsed (see `TMSArchive.diff`).  Yields a tuple
+    for each `.locres` file which differs: its filename, and the output of
+    `diff_locres` (with files which are only present in one archive being
+    compared against an empty `.locres`).  `stats` may be an `oaktms.Stats`
+    object to collect timings in.
+    """
+    from oaktms import TMSArchive
+    old_tms = TMSArchive(old_archive, lazy=True, jobs=jobs, stats=stats)
+    new_tms = TMSArchive(new_archive, lazy=True, jobs=jobs, stats=stats)
+    patterns = ['*.locres']
+    added, removed, modified = old_tms.diff(new_tms, patterns)
+    if include:
+        selected = set(old_tms.entry_name(idx) for idx in old_tms.select(include)) \
+                | set(new_tms.entry_name(idx) for idx in new_tms.select(include))
+        added = [f for f in added if f in selected]
+        removed = [f for f in removed if f in selected]
+        modified = [f for f in modified if f in selected]
+    empty = _INT32.pack(0)
+    for filename in sorted(added + removed + modified):
+        old_data = old_tms.read(filename) if filename in old_tms else empty
+        new_data = new_tms.read(filename) if filename in new_tms else empty
+        with LocRes(old_data, stats) as old, LocRes(new_data, stats) as new:
+            yield (filename, diff_locres(old, new))
+
+def print_locres_diff(namespaces):
+    """
+    Prints out the output of `diff_locres`
+    """
+    for namespace, added, removed, changed in namespaces:
+        label = 'Namespace "{}"'.format(namespace)
+        print(label)
+        print('='*len(label))
+        print('')
+        for key, line in added:
+            print('+ {}'.format(key))
+            print('  + {}'.format(line))
+        for key, line in removed:
+            print('- {}'.format(key))
+            print('  - {}'.format(line))
+        for key, old_line, new_line in changed:
+            print('~ {}'.format(key))
+            print('  - {}'.format(old_line))
+            print('  + {}'.format(new_line))
+        print('')
+
+def print_locres(locres):
+    """
+    Prints out the full contents of the given `LocRes`
+    """
+    for ns_idx in range(locres.namespace_count()):
+        label = 'Namespace "{}"'.format(locres.namespace(ns_idx))
+        print(label)
+        print('='*len(label))
+        print('')
+        for key_idx in locres.namespace_keys(ns_idx):
+            print(locres.key(key_idx))
+            print(locres.line(key_idx))
+            print('')
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
             description='Display .locres contents',
             )
+    parser.add_argument('-g', '--get',
+            nargs=2,
+            metavar=('NAMESPACE', 'KEY'),
+            help='Only display the string for the specified namespace and key',
+            )
+    parser.add_argument('-a', '--archive',
+            action='store_true',
+            help='Treat the file as an OakTMS/DaffodilTMS archive, and parse all the .locres files inside it',
+            )
+    parser.add_argument('--include',
+            type=str,
+            action='append',
+            metavar='PATTERN',
+            help='With --archive, only parse .locres files matching this glob pattern.  May be specified more than once',
+            )
+    parser.add_argument('-e', '--export',
+            type=str,
+            metavar='OUTPUT',
+            help='Export all strings to OUTPUT rather than displaying them: JSON Lines if OUTPUT ends in .jsonl, or a SQLite database otherwise.  The filename may also be a directory of .locres files, when exporting',
+            )
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of worker processes to use while exporting, and threads to use while decompressing archives (defaults to the number of CPUs)',
+            )
+    parser.add_argument('--search-db',
+            type=str,
+            metavar='DB',
+            help='Full-text search index database.  If a filename is given, the index will be updated with its strings (only re-indexing changed .locres files).  Use with --search to query',
+            )
+    parser.add_argument('--source',
+            type=str,
+            help='Label to store strings under when updating the search index (defaults to the base filename)',
+            )
+    parser.add_argument('-s', '--search',
+            type=str,
+            metavar='QUERY',
+            help='Search the --search-db index for strings containing all the words in QUERY',
+            )
+    parser.add_argument('-d', '--diff',
+            type=str,
+            metavar='OTHER',
+            help='Show keys which were added (+), removed (-), or changed (~) in OTHER, compared to the file.  With --archive, compares every .locres file in the two archives.  Exits with status 1 if there are any differences',
+            )
+    parser.add_argument('--stats',
+            type=str,
+            metavar='STATS_FILE',
+            help='Write JSON timing, throughput, and memory statistics for each phase of processing to STATS_FILE (or to stderr, if `-`, so it stays separate from the normal output)',
+            )
+    parser.add_argument('--set',
+            nargs=3,
+            action='append',
+            metavar=('NAMESPACE', 'KEY', 'TEXT'),
+            help='Replace the string for the specified namespace and key, writing the patched file to --output.  May be specified more than once',
+            )
+    parser.add_argument('--entry',
+            type=str,
+            help='With --set and --archive, the .locres file inside the archive to patch.  Only the chunks covering it get recompressed',
+            )
+    parser.add_argument('--short-chunks',
+            action='store_true',
+            help='With --set and --archive, only recompress the chunks covering the patched file, rather than re-chunking everything after it.  Much faster, but leaves a short chunk in the middle of the archive, which the game may not accept',
+            )
+    parser.add_argument('-o', '--output',
+            type=str,
+            help='Filename to write the patched file to, with --set',
+            )
     parser.add_argument('filename',
-            nargs=1,
+            nargs='?',
             help='Filename to parse',
             )
     args = parser.parse_args()
-    filename = args.filename[0]
-
-    namespaces = []
-    strings = []
-    with open(filename, 'rb') as df:
-        # Fudging a bit here.
-        df.seek(0x19)
-        namespace_count = _uint32(df)
-        for _ in range(namespace_count):
-            namespaces.append(Namespace(df))
-
-        string_count = _uint32(df)
-        for _ in range(string_count):
-            strings.append(_str(df))
-
-    for ns in namespaces:
-        label = 'Namespace "{}"'.format(ns.name)
-        print(label)
-        print('='*len(label))
-        print('')
-        for key in ns.keys:
-            print(key.key)
-            print(strings[key.number])
-            print('')
+    filename = args.filename
+    if args.search and not args.search_db:
+        parser.error('--search requires --search-db')
+    if not filename and not args.search:
+        parser.error('the following arguments are required: filename')
+    if args.set and not args.output:
+        parser.error('--set requires --output')
+    if args.set and args.archive and not args.entry:
+        parser.error('--set with --archive requires --entry')
+
+    # Stats get written out however we end up exiting
+    if args.stats:
+        from oaktms import Stats
+        stats = Stats('locres')
+        atexit.register(stats.write, args.stats)
+        stats_phase = stats.phase
+    else:
+        stats = None
+        stats_phase = lambda name, nbytes=0: contextlib.nullcontext({})
+
+    if args.search_db:
+        with SearchIndex(args.search_db) as index:
+            if filename:
+                source = args.source or os.path.basename(os.path.normpath(filename))
+                sources = iter_locres_sources(filename, args.archive, args.include, jobs=args.jobs, stats=stats)
+                with stats_phase('index'):
+                    counts = index.update(source, sources)
+                print('Updated {} in {}: {} added, {} changed, {} unchanged, {} removed'.format(
+                    source,
+                    args.search_db,
+                    counts['added'],
+                    counts['changed'],
+                    counts['unchanged'],
+                    counts['removed'],
+                    ))
+            if args.search:
+                with stats_phase('search'):
+                    results = list(index.search(args.search))
+                for source, locres_filename, language, namespace, key, text in results:
+                    print('{}:{} [{}] {}: {}'.format(source, locres_filename, namespace, key, text))
+        sys.exit(0)
+
+    if args.set:
+        edits = {(namespace, key): text for namespace, key, text in args.set}
+        with stats_phase('read') as phase:
+            with open(filename, 'rb') as df:
+                data = df.read()
+            phase['bytes'] = len(data)
+        try:
+            if args.archive:
+                from oaktms import TMSArchive, patch_archive
+                archive = TMSArchive(data, lazy=True, jobs=args.jobs, stats=stats)
+                if args.entry not in archive:
+                    print('ERROR: File "{}" not found in archive'.format(args.entry))
+                    sys.exit(1)
+                with LocRes(archive.read(args.entry), stats) as locres, stats_phase('encode'):
+                    new_locres = locres.encode(edits)
+                with stats_phase('patch', len(data)):
+                    new_data, recompressed = patch_archive(archive, {args.entry: new_locres},
+                            jobs=args.jobs, uniform=not args.short_chunks)
+            else:
+                with LocRes(data, stats) as locres, stats_phase('encode'):
+                    new_data = locres.encode(edits)
+        except KeyError as e:
+            namespace, key = e.args[0]
+            print('ERROR: Key "{}" not found in namespace "{}"'.format(key, namespace))
+            sys.exit(1)
+        # (Replaced rather than written into, in case it's a hardlink)
+        from oaktms import replace_file
+        with stats_phase('write', len(new_data)):
+            replace_file(args.output, new_data)
+        if args.archive:
+            print('Patched {} string(s) in {}, recompressing {} of {} chunks, to {}'.format(
+                len(edits),
+                args.entry,
+                recompressed,
+                len(archive.chunks),
+                args.output,
+                ))
+        else:
+            print('Patched {} string(s) to {}'.format(len(edits), args.output))
+        sys.exit(0)
+
+    if args.diff:
+        different = False
+        if args.archive:
+            for locres_filename, namespaces in diff_archive_locres(filename, args.diff, args.include, jobs=args.jobs, stats=stats):
+                label = 'File "{}"'.format(locres_filename)
+                print(label)
+                print('#'*len(label))
+                print('')
+                print_locres_diff(namespaces)
+                different = different or bool(namespaces)
+        else:
+            with LocRes(filename, stats) as old, LocRes(args.diff, stats) as new:
+                with stats_phase('diff'):
+                    namespaces = diff_locres(old, new)
+            print_locres_diff(namespaces)
+            different = bool(namespaces)
+        if different:
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.export:
+        sources = iter_locres_sources(filename, args.archive, args.include, jobs=args.jobs, stats=stats)
+        with stats_phase('export'):
+            num_rows = export_locres(sources, args.export, jobs=args.jobs)
+        print('Exported {} strings to {}'.format(num_rows, args.export))
+        sys.exit(0)
+
+    if args.archive:
+        found = False
+        for locres_filename, locres in iter_archive_locres(filename, args.include, jobs=args.jobs, stats=stats):
+            with locres:
+                if args.get:
+                    try:
+                        print('{}: {}'.format(locres_filename, locres.get(*args.get)))
+                        found = True
+                    except KeyError:
+                        pass
+                else:
+                    label = 'File "{}"'.format(locres_filename)
+                    print(label)
+                    print('#'*len(label))
+                    print('')
+                    with stats_phase('output'):
+                        print_locres(locres)
+        if args.get and not found:
+            print('ERROR: Key "{}" not found in namespace "{}"'.format(args.get[1], args.get[0]))
+            sys.exit(1)
+        sys.exit(0)
+
+    try:
+        locres = LocRes(filename, stats)
+    except RuntimeError as e:
+        print('ERROR: {}: {}'.format(filename, e))
+        sys.exit(1)
+    with locres:
+        if args.get:
+            try:
+                with stats_phase('lookup'):
+                    line = locres.get(*args.get)
+                print(line)
+            except KeyError:
+                print('ERROR: Key "{}" not found in namespace "{}"'.format(args.get[1], args.get[0]))
+                sys.exit(1)
+        else:
+            with stats_phase('output'):
+                print_locres(locres)
 
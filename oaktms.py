@@ -21,9 +21,230 @@
 import io
 import os
 import sys
+import json
 import zlib
+import time
+import array
+import bisect
+import shutil
+import fnmatch
+import hashlib
 import struct
 import argparse
+import threading
+import http.client
+import urllib.parse
+import collections
+import contextlib
+import concurrent.futures
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; we just won't report peak RSS there
+    resource = None
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process, in bytes, or `None`
+    if we can't find out on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+class PathTrie:
+    """
+    Trie of the path components of an archive's filenames, used to match
+    glob patterns against whole directories at a time rather than testing
+    every filename individually.  Directories are stored as dicts keyed
+    by path component, and files are stored as their index in the archive.
+    """
+
+    def __init__(self, filenames):
+        self.root = {}
+        for idx, filename in enumerate(filenames):
+            node = self.root
+            parts = filename.split('/')
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = idx
+
+    def match(self, pattern):
+        """
+        Returns a set of the file indexes which match the given glob
+        pattern.  `*`, `?`, and `[]` match within a single path component,
+        and a `**` component matches any number of directories.  Patterns
+        match any trailing portion of a path unless they start with `/`,
+        and a pattern which matches a directory matches everything inside
+        it.
+        """
+        if pattern.startswith('/'):
+            parts = pattern[1:].split('/')
+        else:
+            parts = ['**'] + pattern.split('/')
+        matches = set()
+        self._match(self.root, [p for p in parts if p != ''], matches)
+        return matches
+
+    def _match(self, node, parts, matches):
+        """
+        Recursively matches the given pattern components against the
+        given trie node, adding matched file indexes to `matches`
+        """
+        if not parts:
+            self._add_all(node, matches)
+            return
+        part = parts[0]
+        rest = parts[1:]
+
+        if part == '**':
+            self._match(node, rest, matches)
+            for child in node.values():
+                if isinstance(child, dict):
+                    self._match(child, parts, matches)
+            return
+
+        if any(c in part for c in '*?['):
+            children = [child for name, child in node.items() if fnmatch.fnmatchcase(name, part)]
+        elif part in node:
+            children = [node[part]]
+        else:
+            children = []
+        for child in children:
+            if isinstance(child, dict):
+                self._match(child, rest, matches)
+            elif not rest:
+                matches.add(child)
+
+    def _add_all(self, node, matches):
+        """
+        Adds every file index at or below the given trie node to `matches`
+        """
+        if isinstance(node, dict):
+            for child in node.values():
+                self._add_all(child, matches)
+        else:
+            matches.add(node)
+
+class Stats:
+    """
+    Collects the wall time, CPU time, and number of bytes processed for
+    each phase of processing (as named by the caller), along with the
+    sizes of each compressed chunk, for reporting via `--stats`.  Phases
+    may be entered any number of times, and their totals accumulate.
+    Phases may also be nested, in which case time spent in the inner phase
+    is not counted towards the outer one.
+
+    CPU time is measured for the whole process, so it includes the work
+    done by any thread pools while the phase is running.
+    """
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.phases = {}
+        self.chunks = []
+        self._stack = []
+        self._lock = threading.Lock()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def phase(self, name, nbytes=0):
+        """
+        Context manager which times the enclosed code as part of the named
+        phase.  It yields a dict whose `bytes` entry (initially `nbytes`)
+        will be added to the phase's byte count, for when that isn't known
+        up front.  Should only be used from the main thread; see `add()`
+        for work done elsewhere.
+        """
+        frame = {'bytes': nbytes, 'child_wall': 0, 'child_cpu': 0}
+        self._stack.append(frame)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield frame
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]['child_wall'] += wall
+                self._stack[-1]['child_cpu'] += cpu
+            self.add(name, wall - frame['child_wall'], cpu - frame['child_cpu'], frame['bytes'])
+
+    def add(self, name, wall=0, cpu=0, nbytes=0):
+        """
+        Adds the given times and byte count to the named phase.  This is
+        safe to call from worker threads.
+        """
+        with self._lock:
+            if name not in self.phases:
+                self.phases[name] = {'wall': 0, 'cpu': 0, 'bytes': 0, 'calls': 0}
+            phase = self.phases[name]
+            phase['wall'] += wall
+            phase['cpu'] += cpu
+            phase['bytes'] += nbytes
+            phase['calls'] += 1
+
+    def chunk(self, comp_size, uncomp_size):
+        """
+        Records the compressed and uncompressed size of a chunk
+        """
+        self.chunks.append((comp_size, uncomp_size))
+
+    def peak_rss(self):
+        """
+        Returns the peak resident set size of the process, in bytes, or
+        `None` if we can't find out on this platform.
+        """
+        return peak_rss()
+
+    def report(self):
+        """
+        Returns a dict of all our statistics, suitable for JSON output
+        """
+        total_comp = sum(c[0] for c in self.chunks)
+        total_uncomp = sum(c[1] for c in self.chunks)
+        return {
+                'tool': self.tool,
+                'wall': time.perf_counter() - self._start_wall,
+                'cpu': time.process_time() - self._start_cpu,
+                'peak_rss': self.peak_rss(),
+                'phases': self.phases,
+                'compression_ratio': total_comp / total_uncomp if total_uncomp else None,
+                'chunks': [{
+                    'compressed': comp_size,
+                    'uncompressed': uncomp_size,
+                    'ratio': comp_size / uncomp_size if uncomp_size else None,
+                    } for comp_size, uncomp_size in self.chunks],
+                }
+
+    def write(self, filename):
+        """
+        Writes our statistics as JSON to the specified file, or to stderr
+        if the filename is `-` (so they don't get mixed in with the
+        tool's regular output on stdout)
+        """
+        if filename == '-':
+            json.dump(self.report(), sys.stderr, indent=2)
+            print('', file=sys.stderr)
+        else:
+            with open(filename, 'w') as odf:
+                json.dump(self.report(), odf, indent=2)
+
+def stats_phase(stats, name, nbytes=0):
+    """
+    Returns a context manager which times the enclosed code as part of the
+    named phase in `stats` (see `Stats.phase`), or does nothing if `stats`
+    is `None`
+    """
+    if stats is None:
+        return contextlib.nullcontext({})
+    return stats.phase(name, nbytes)
 
 class TMSArchive:
     """
@@ -46,12 +267,89 @@ class TMSArchive:
     As of writing, BL3 Steam+EGS versions are identical, as you'd hope.
     """
 
-    def __init__(self, filename, verbose=False):
+    # Version of our sidecar index cache format
+    INDEX_CACHE_VERSION = 1
+
+    # Size of the header, before the chunk table: two uint32s and four ulong64s
+    HEADER_SIZE = 4*2 + 8*4
+
+    # Number of decompressed chunks to keep around in lazy mode
+    CHUNK_CACHE_SIZE = 8
+
+    def __init__(self, filename, verbose=False, lazy=False, stream=False, jobs=1, index_cache=False, stats=None):
+        """
+        `filename` is usually the path to the archive, but may also be the
+        archive data itself (as `bytes`, a `bytearray`, or a `memoryview`),
+        or a binary file-like object.  In the latter cases, the `filename`
+        attribute will be `None`, and no index cache is used.  File-like
+        objects which aren't seekable (such as an HTTP response) can only be
+        opened with `stream=True`, and are read strictly front-to-back: the
+        footer info is only available once the archive has been iterated
+        over.
 
-        self.filename = filename
-        self.files = {}
+        If `lazy` is `True`, only the header, chunk table, and the file entry
+        headers will be read in when the archive is opened.  File contents
+        will then be decompressed on-demand (only the chunks which cover the
+        requested file) via `read()`, rather than having the entire archive
+        decompressed into memory up front.
+
+        If `stream` is `True`, only the header and chunk table will be read
+        when the archive is opened.  Iterating over the archive will then
+        decompress it chunk-by-chunk, yielding each file as soon as it's
+        been completely decompressed.  Only a few chunks (plus whatever
+        file is currently being assembled) are held in memory at once.
+        A streaming archive can only be iterated over.
+
+        `jobs` is the number of threads to use when decompressing the whole
+        archive at once (or, when streaming, the number of chunks to
+        decompress ahead of the file currently being assembled).
+
+        If `index_cache` is `True`, a sidecar index file (the archive filename
+        with `.idx` appended) will be written whenever we build our file
+        index, and lazy archives will load their index from it rather than
+        decompressing anything, so long as the archive's size, mtime, and
+        header all still match.  `index_cache` can also be a string, to
+        store the index somewhere other than alongside the archive.
+
+        If `stats` is passed in, it should be a `Stats` object, which will
+        be updated with timings for each phase of processing.
+        """
+
+        self._fileobj = None
+        if isinstance(filename, (str, os.PathLike)):
+            self.filename = os.fspath(filename)
+        else:
+            if isinstance(filename, (bytes, bytearray, memoryview)):
+                self._fileobj = io.BytesIO(filename)
+            else:
+                self._fileobj = filename
+            self.filename = None
+            index_cache = False
+        self.raw_names = []
+        self.offsets = array.array('Q')
+        self.lengths = array.array('Q')
+        self._lookup = None
+        self._trie = None
+        self._chunk_digests = None
+        self._data = None
         self.verbose = verbose
+        self.lazy = lazy
+        self.stream = stream
+        self.jobs = max(1, jobs)
+        self.stats = stats
+        if index_cache is True:
+            self.index_cache = '{}.idx'.format(self.filename)
+        else:
+            self.index_cache = index_cache
         self.common_prefix = ''
+        self.chunk_size = 0
+        self.chunks = []
+        self.footer_strs = []
+        self.footer_nums = (0, 0)
+        self._chunk_cache = collections.OrderedDict()
+        self.sequential = self._fileobj is not None and not self._fileobj.seekable()
+        if self.sequential and not self.stream:
+            raise RuntimeError('Non-seekable archives can only be opened with stream=True')
         self._process()
 
     def _process(self):
@@ -59,101 +357,689 @@ class TMSArchive:
         Process the file (read in all the info)
         """
 
-        file_stat = os.stat(self.filename)
-        total_size = file_stat.st_size
-        if self.verbose:
-            print('File size: {}'.format(total_size))
+        with self._open() as df:
+
+            if self.sequential:
+                file_stat = None
+                total_size = None
+            elif self.filename is None:
+                file_stat = None
+                total_size = df.seek(0, io.SEEK_END)
+                df.seek(0)
+            else:
+                file_stat = os.fstat(df.fileno())
+                total_size = file_stat.st_size
+            if self.verbose and total_size is not None:
+                print('File size: {}'.format(total_size))
 
-        with open(self.filename, 'rb') as df:
+            with self._phase('header') as phase:
+                self._read_header(df)
+                phase['bytes'] = self.data_offset
 
-            total_uncomp_size = self._uint32(df)
+            if self.lazy:
+                with self._phase('index_cache'):
+                    loaded = self._load_index_cache(df, file_stat)
+                if loaded:
+                    return
+
+            if self.sequential:
+                # We can't skip ahead to the footer; it'll be read in once
+                # we've streamed through all the chunks.
+                return
+
+            if self.lazy or self.stream:
+                # Skip right past the compressed data to the footer, and then
+                # (if we're lazy) walk the file entry headers to build our
+                # index.  Streaming archives don't do anything else until
+                # they're iterated over.
+                df.seek(self.data_offset + self.total_comp_size)
+                with self._phase('footer', total_size - df.tell()):
+                    self._read_footer(df, total_size)
+                if self.lazy:
+                    with self._phase('entries', self.total_uncomp_size):
+                        self._build_index(lambda offset, length: self._read_range(df, offset, length))
+                    with self._phase('finish'):
+                        self._finish()
+                    with self._phase('index_cache'):
+                        self._save_index_cache(df, file_stat)
+                return
+
+            # Read in the chunks
+            with self._phase('decompress', self.total_uncomp_size):
+                self._data = memoryview(self._decompress_all(df)).toreadonly()
             if self.verbose:
-                print('Total uncompressed size: {}'.format(total_uncomp_size))
-            filecount = self._uint32(df)
+                print('Total bytes in zlib-decompressed area: {}'.format(len(self._data)))
+
+            # Read in the footer info
+            with self._phase('footer', total_size - df.tell()):
+                self._read_footer(df, total_size)
+
+        # Now process the decompressed data.  File contents are never copied
+        # out of the decompressed buffer; we just keep track of where they
+        # live.
+        with self._phase('entries', self.total_uncomp_size):
+            self._build_index(lambda offset, length: self._data[offset:offset+length])
+        with self._phase('finish'):
+            self._finish()
+        with self._open() as df:
+            with self._phase('index_cache'):
+                self._save_index_cache(df, file_stat)
+
+    def _phase(self, name, nbytes=0):
+        """
+        Returns a context manager which times the enclosed code as part of
+        the named phase, if we're collecting stats (see `Stats.phase`).
+        """
+        return stats_phase(self.stats, name, nbytes)
+
+    def _timed(self, name, iterable):
+        """
+        Yields each item from `iterable`, counting the time spent producing
+        each one (and its length) towards the named phase
+        """
+        iterator = iter(iterable)
+        while True:
+            with self._phase(name) as phase:
+                item = next(iterator, None)
+                if item is not None:
+                    phase['bytes'] = len(item)
+            if item is None:
+                return
+            yield item
+
+    def _open(self):
+        """
+        Returns a binary file object for the archive, to be used as a
+        context manager.  File-like objects and in-memory data we've
+        been given are left open.
+        """
+        if self._fileobj is not None:
+            return contextlib.nullcontext(self._fileobj)
+        return open(self.filename, 'rb')
+
+    def _decompress_all(self, df):
+        """
+        Decompresses all chunks into a single preallocated buffer, which
+        is returned.  The chunk table tells us where each chunk lives in
+        both the file and the uncompressed data, so chunks can be
+        decompressed independently of each other.  If we have more than
+        one job, that'll happen in a thread pool (zlib releases the GIL
+        while it works).
+        """
+        comp_data = memoryview(df.read(self.total_comp_size))
+        assert(len(comp_data) == self.total_comp_size)
+        data = bytearray(self.total_uncomp_size)
+        out = memoryview(data)
+
+        def decompress_chunk(chunk):
+            comp_offset, comp_size, uncomp_offset, uncomp_size = chunk
+            start = comp_offset - self.data_offset
+            chunk_data = zlib.decompress(comp_data[start:start+comp_size], bufsize=max(1, uncomp_size))
+            assert(len(chunk_data) == uncomp_size)
+            out[uncomp_offset:uncomp_offset+uncomp_size] = chunk_data
+
+        if self.jobs > 1 and len(self.chunks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                list(executor.map(decompress_chunk, self.chunks))
+        else:
+            for chunk in self.chunks:
+                decompress_chunk(chunk)
+
+        return data
+
+    def _read_header(self, df):
+        """
+        Reads the header and chunk table from the specified file.  Each
+        entry in `self.chunks` is a tuple of the chunk's offset in the
+        TMS file, its compressed size, its offset in the uncompressed
+        data, and its uncompressed size.
+        """
+
+        self.total_uncomp_size = self._uint32(df)
+        if self.verbose:
+            print('Total uncompressed size: {}'.format(self.total_uncomp_size))
+        self.filecount = self._uint32(df)
+        if self.verbose:
+            print('File count: {}'.format(self.filecount))
+
+        sig = self._ulong64(df)
+        assert(sig == 0x9E2A83C1)
+
+        self.chunk_size = self._ulong64(df)
+        if self.verbose:
+            print('Chunk size: {}'.format(self.chunk_size))
+
+        self.total_comp_size = self._ulong64(df)
+        new_uncomp_size = self._ulong64(df)
+        assert(new_uncomp_size == self.total_uncomp_size)
+
+        chunk_sizes = []
+        cur_comp_size = 0
+        cur_uncomp_size = 0
+        while True:
+
+            chunk_comp_size = self._ulong64(df)
+            chunk_uncomp_size = self._ulong64(df)
+            cur_comp_size += chunk_comp_size
+            cur_uncomp_size += chunk_uncomp_size
+
             if self.verbose:
-                print('File count: {}'.format(filecount))
+                print('Got chunk, compressed: {}, uncompressed: {}'.format(chunk_comp_size, chunk_uncomp_size))
+            chunk_sizes.append((chunk_comp_size, chunk_uncomp_size))
+            if cur_comp_size == self.total_comp_size:
+                assert(cur_uncomp_size == self.total_uncomp_size)
+                break
+            assert(cur_comp_size < self.total_comp_size)
+            assert(cur_uncomp_size < self.total_uncomp_size)
+
+        if self.verbose:
+            print('Got {} zlib chunks'.format(len(chunk_sizes)))
 
-            sig = self._ulong64(df)
-            assert(sig == 0x9E2A83C1)
+        # Figure out where each chunk lives, both in the file and in the
+        # uncompressed data
+        self.data_offset = self.HEADER_SIZE + len(chunk_sizes)*16
+        self.chunks = []
+        comp_offset = self.data_offset
+        uncomp_offset = 0
+        for chunk_comp_size, chunk_uncomp_size in chunk_sizes:
+            self.chunks.append((comp_offset, chunk_comp_size, uncomp_offset, chunk_uncomp_size))
+            comp_offset += chunk_comp_size
+            uncomp_offset += chunk_uncomp_size
+            if self.stats is not None:
+                self.stats.chunk(chunk_comp_size, chunk_uncomp_size)
+        self._chunk_starts = [c[2] for c in self.chunks]
 
-            chunk_size = self._ulong64(df)
+    def _read_footer(self, df, total_size):
+        """
+        Reads the footer info from the specified file (which should
+        already be positioned right after the compressed data).  If
+        `total_size` is `None`, the file isn't seekable, and we just make
+        sure that there's nothing left to read.
+        """
+        num_strs = self._uint32(df)
+        self.footer_strs = []
+        for idx in range(num_strs):
+            footer_str = self._str(df)
+            self.footer_strs.append(footer_str)
             if self.verbose:
-                print('Chunk size: {}'.format(chunk_size))
+                print('Footer string {}: {}'.format(idx+1, footer_str))
+        footer_num_1 = self._uint32(df)
+        footer_num_2 = self._uint32(df)
+        self.footer_nums = (footer_num_1, footer_num_2)
+        if self.verbose:
+            print('Footer num 1: {}'.format(footer_num_1))
+            print('Footer num 2: {}'.format(footer_num_2))
+        if total_size is None:
+            assert(df.read(1) == b'')
+        else:
+            assert(df.tell() == total_size)
 
-            total_comp_size = self._ulong64(df)
-            new_uncomp_size = self._ulong64(df)
-            assert(new_uncomp_size == total_uncomp_size)
+    def _build_index(self, read_range):
+        """
+        Walks the file entry headers to build up our index of filenames,
+        uncompressed offsets, and lengths (`raw_names`, `offsets`, and
+        `lengths`, respectively).  `read_range` should be a
+        function which takes an offset and length in the uncompressed
+        data, and returns the data found there.  In lazy mode, that means
+        that chunks which only contain file contents will never be
+        decompressed.
+        """
+        offset = 0
+        for _ in range(self.filecount):
+            strlen = struct.unpack('<I', read_range(offset, 4))[0]
+            filename = bytes(read_range(offset+4, strlen))[:-1].decode('utf-8')
+            offset += 4 + strlen
+            contents_len = struct.unpack('<I', read_range(offset, 4))[0]
+            offset += 4
+            self._add_entry(filename, offset, contents_len)
+            offset += contents_len
+            if self.verbose:
+                print('Raw TMS filename found: {}'.format(filename))
+        assert(offset == self.total_uncomp_size)
 
-            chunk_sizes = []
-            cur_comp_size = 0
-            cur_uncomp_size = 0
-            while True:
+    def _header_hash(self, df):
+        """
+        Returns a hash of the archive header and chunk table, for use in
+        validating our sidecar index cache
+        """
+        df.seek(0)
+        return hashlib.sha1(df.read(self.data_offset)).hexdigest()
 
-                chunk_comp_size = self._ulong64(df)
-                chunk_uncomp_size = self._ulong64(df)
-                cur_comp_size += chunk_comp_size
-                cur_uncomp_size += chunk_uncomp_size
+    def _index_cache_key(self, df, file_stat):
+        """
+        Returns the values which a sidecar index cache must match in order
+        to be used for this archive
+        """
+        return {
+                'version': self.INDEX_CACHE_VERSION,
+                'size': file_stat.st_size,
+                'mtime_ns': file_stat.st_mtime_ns,
+                'header_hash': self._header_hash(df),
+                }
 
+    def _load_index_cache(self, df, file_stat):
+        """
+        Attempts to load our file index (and footer info) from our sidecar
+        index cache.  Returns `True` if the cache was valid and has been
+        loaded, or `False` otherwise.
+        """
+        if not self.index_cache or not os.path.exists(self.index_cache):
+            return False
+        try:
+            with open(self.index_cache, 'r', encoding='utf-8') as idf:
+                cache = json.load(idf)
+        except (OSError, ValueError) as e:
+            if self.verbose:
+                print('Could not read index cache {}: {}'.format(self.index_cache, e))
+            return False
+        for key, value in self._index_cache_key(df, file_stat).items():
+            if cache.get(key) != value:
                 if self.verbose:
-                    print('Got chunk, compressed: {}, uncompressed: {}'.format(chunk_comp_size, chunk_uncomp_size))
-                chunk_sizes.append((chunk_comp_size, chunk_uncomp_size))
-                if cur_comp_size == total_comp_size:
-                    assert(cur_uncomp_size == total_uncomp_size)
-                    break
-                assert(cur_comp_size < total_comp_size)
-                assert(cur_uncomp_size < total_uncomp_size)
+                    print('Index cache {} is stale ({} mismatch)'.format(self.index_cache, key))
+                return False
+        assert(cache['chunks'] == [[c[1], c[3]] for c in self.chunks])
+
+        if self.verbose:
+            print('Loading file index from {}'.format(self.index_cache))
+        self.footer_strs = cache['footer_strs']
+        self.footer_nums = tuple(cache['footer_nums'])
+        if self.verbose:
+            for idx, footer_str in enumerate(self.footer_strs):
+                print('Footer string {}: {}'.format(idx+1, footer_str))
+            print('Footer num 1: {}'.format(self.footer_nums[0]))
+            print('Footer num 2: {}'.format(self.footer_nums[1]))
+        self.raw_names = cache['names']
+        self.offsets = array.array('Q', cache['offsets'])
+        self.lengths = array.array('Q', cache['lengths'])
+        self._finish()
+        return True
 
+    def _save_index_cache(self, df, file_stat):
+        """
+        Writes out our file index, footer info, and chunk table to our
+        sidecar index cache (if we've been told to use one).  Failure to
+        write the cache is not considered an error.
+        """
+        if not self.index_cache:
+            return
+        cache = self._index_cache_key(df, file_stat)
+        cache['chunks'] = [[c[1], c[3]] for c in self.chunks]
+        cache['footer_strs'] = self.footer_strs
+        cache['footer_nums'] = list(self.footer_nums)
+        cache['names'] = self.raw_names
+        cache['offsets'] = self.offsets.tolist()
+        cache['lengths'] = self.lengths.tolist()
+        temp_filename = '{}.tmp{}'.format(self.index_cache, os.getpid())
+        try:
+            with open(temp_filename, 'w', encoding='utf-8') as odf:
+                json.dump(cache, odf)
+            os.replace(temp_filename, self.index_cache)
             if self.verbose:
-                print('Got {} zlib chunks'.format(len(chunk_sizes)))
+                print('Wrote index cache to {}'.format(self.index_cache))
+        except OSError as e:
+            if self.verbose:
+                print('Could not write index cache {}: {}'.format(self.index_cache, e))
 
-            # Read in the chunks
-            data_list = []
-            for chunk_comp_size, chunk_uncomp_size in chunk_sizes:
-                data_list.append(zlib.decompress(df.read(chunk_comp_size)))
-            data = b''.join(data_list)
-            assert(len(data) == total_uncomp_size)
+    def _add_entry(self, filename, offset, length):
+        """
+        Adds a file to our index, using its raw (unstripped) filename
+        """
+        self.raw_names.append(filename)
+        self.offsets.append(offset)
+        self.lengths.append(length)
 
-            # Read in the footer info
-            num_strs = self._uint32(df)
-            for idx in range(num_strs):
-                footer_str = self._str(df)
-                if self.verbose:
-                    print('Footer string {}: {}'.format(idx+1, footer_str))
-            footer_num_1 = self._uint32(df)
-            footer_num_2 = self._uint32(df)
-            if self.verbose:
-                print('Footer num 1: {}'.format(footer_num_1))
-                print('Footer num 2: {}'.format(footer_num_2))
-            assert(df.tell() == total_size)
+    def _iter_chunks(self, df):
+        """
+        Yields the decompressed data for each chunk, in order.  If we have
+        more than one job, chunks will be decompressed ahead of time in a
+        thread pool, keeping at most `self.jobs` chunks in flight.  For
+        sequential archives, each chunk is decompressed as soon as its
+        compressed data has arrived.
+        """
+        if not self.sequential:
+            df.seek(self.data_offset)
+        if self.jobs > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                pending = collections.deque()
+                for _, comp_size, _, uncomp_size in self.chunks:
+                    pending.append(executor.submit(zlib.decompress, self._read_exactly(df, comp_size), bufsize=max(1, uncomp_size)))
+                    if len(pending) >= self.jobs:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+        else:
+            for _, comp_size, _, uncomp_size in self.chunks:
+                yield zlib.decompress(self._read_exactly(df, comp_size), bufsize=max(1, uncomp_size))
 
-            # Now process the decompressed data
-            idf = io.BytesIO(data)
+    def _read_exactly(self, df, length):
+        """
+        Reads exactly `length` bytes from the specified file, raising a
+        `RuntimeError` if it ends early.  (Reads from things like network
+        streams may come back short.)
+        """
+        parts = []
+        while length > 0:
+            data = df.read(length)
+            if not data:
+                raise RuntimeError('Archive data ended unexpectedly')
+            parts.append(data)
+            length -= len(data)
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def _iter_stream(self):
+        """
+        Decompresses the archive chunk-by-chunk, yielding a tuple of the
+        filename and contents for each file as soon as it's complete.
+        Files may span any number of chunks.
+
+        Since we can't know the common path prefix until we've seen every
+        filename, the prefix is taken from the first file, and every
+        subsequent file must share it.  (That's the same condition under
+        which `_finish` would allow the archive, anyway.)
+        """
+        self.common_prefix = None
+        del self.raw_names[:]
+        del self.offsets[:]
+        del self.lengths[:]
+        self._lookup = None
+        buf = bytearray()
+        buf_offset = 0
+        files_left = self.filecount
+        with self._open() as df:
+            for chunk_idx, chunk_data in enumerate(self._timed('decompress', self._iter_chunks(df))):
+                assert(len(chunk_data) == self.chunks[chunk_idx][3])
+                buf += chunk_data
+                pos = 0
+                while files_left > 0:
+
+                    # See if we have a complete file in our buffer yet
+                    with self._phase('entries') as phase:
+                        entry = self._parse_streamed(buf, pos)
+                        if entry is not None:
+                            filename, start, end = entry
+                            if self.verbose:
+                                print('Raw TMS filename found: {}'.format(filename))
+                            self._add_entry(filename, buf_offset + start, end - start)
+                            with memoryview(buf) as view:
+                                contents = bytes(view[start:end])
+                            phase['bytes'] = end - pos
+                    if entry is None:
+                        break
+                    with self._phase('finish'):
+                        new_filename = self._strip_streamed(filename)
+                    pos = end
+                    files_left -= 1
+                    yield (new_filename, contents)
+
+                # Discard whatever we've finished with
+                del buf[:pos]
+                buf_offset += pos
+
+            assert(files_left == 0)
+            assert(len(buf) == 0)
+            if self.sequential:
+                with self._phase('footer'):
+                    self._read_footer(df, None)
+            if self.filename is not None:
+                with self._phase('index_cache'):
+                    self._save_index_cache(df, os.fstat(df.fileno()))
+
+    def _parse_streamed(self, buf, pos):
+        """
+        Parses the file entry starting at `pos` in the streaming buffer
+        `buf`.  Returns a tuple of the raw filename, and the start and end
+        of the file's contents in the buffer, or `None` if the buffer
+        doesn't contain the complete file yet.
+        """
+        if len(buf) - pos < 4:
+            return None
+        strlen = struct.unpack_from('<I', buf, pos)[0]
+        if len(buf) - pos < 8 + strlen:
+            return None
+        contents_len = struct.unpack_from('<I', buf, pos + 4 + strlen)[0]
+        start = pos + 8 + strlen
+        end = start + contents_len
+        if len(buf) < end:
+            return None
+        filename = bytes(buf[pos+4:pos+3+strlen]).decode('utf-8')
+        return (filename, start, end)
 
-            idf.seek(0, io.SEEK_END)
+    def _strip_streamed(self, filename):
+        """
+        Strips the common prefix from a filename encountered while
+        streaming, figuring out what that prefix is from the first file
+        we see.
+        """
+        if self.common_prefix is None:
+            idx = 0
+            for component in filename.split('/'):
+                if component != '..':
+                    break
+                idx += 1
+            self.common_prefix = '../'*idx
             if self.verbose:
-                print('Total bytes in zlib-decompressed area: {}'.format(idf.tell()))
-            idf.seek(0)
+                print('Found common filename prefix: {}'.format(self.common_prefix))
+        if not filename.startswith(self.common_prefix):
+            raise RuntimeError('Filename does not share common prefix {}: {}'.format(self.common_prefix, filename))
+        new_filename = filename[len(self.common_prefix):]
+        if '../' in new_filename:
+            raise RuntimeError('Relative path not allowed in stripped filename: {}'.format(new_filename))
+        return new_filename
 
-            for _ in range(filecount):
-                filename, contents = self._read_file(idf)
-                self.files[filename] = contents
-                if self.verbose:
-                    print('Raw TMS filename found: {}'.format(filename))
-            self._finish()
+    def _chunk(self, df, chunk_idx):
+        """
+        Returns the decompressed data for the specified chunk.  The last
+        few chunks we've used are kept around, since file entries will
+        often share chunks with their neighbors, and so that reading files
+        right after walking the entry headers doesn't decompress their
+        chunks all over again.
+        """
+        if chunk_idx in self._chunk_cache:
+            self._chunk_cache.move_to_end(chunk_idx)
+            return self._chunk_cache[chunk_idx]
+        comp_offset, comp_size, _, uncomp_size = self.chunks[chunk_idx]
+        with self._phase('decompress', uncomp_size):
+            df.seek(comp_offset)
+            data = zlib.decompress(df.read(comp_size))
+        assert(len(data) == uncomp_size)
+        self._chunk_cache[chunk_idx] = data
+        if len(self._chunk_cache) > self.CHUNK_CACHE_SIZE:
+            self._chunk_cache.popitem(last=False)
+        return data
+
+    def _read_range(self, df, offset, length):
+        """
+        Reads `length` bytes starting at `offset` in the uncompressed data,
+        decompressing only the chunks which cover that range.
+        """
+        if length == 0:
+            return b''
+        assert(offset + length <= self.total_uncomp_size)
+        chunk_idx = bisect.bisect_right(self._chunk_starts, offset) - 1
+        parts = []
+        while length > 0:
+            _, _, chunk_start, chunk_len = self.chunks[chunk_idx]
+            data = self._chunk(df, chunk_idx)
+            start = offset - chunk_start
+            part = data[start:start+length]
+            parts.append(part)
+            offset += len(part)
+            length -= len(part)
+            chunk_idx += 1
+        return b''.join(parts)
+
+    def filenames(self):
+        """
+        Yields all the filenames in the archive, with the common prefix
+        stripped
+        """
+        strip_len = len(self.common_prefix)
+        for raw_name in self.raw_names:
+            yield raw_name[strip_len:]
+
+    def entry_name(self, idx):
+        """
+        Returns the filename (with the common prefix stripped) of the
+        file at the specified index
+        """
+        return self.raw_names[idx][len(self.common_prefix):]
+
+    def select(self, include=None, exclude=None):
+        """
+        Returns a sorted list of the indexes of files which match any of
+        the glob patterns in `include` (or all files, if `include` is
+        empty), and none of the patterns in `exclude`.  See `PathTrie.match`
+        for the pattern syntax.
+        """
+        if self._trie is None:
+            self._trie = PathTrie(self.filenames())
+        if include:
+            selected = set()
+            for pattern in include:
+                selected |= self._trie.match(pattern)
+        else:
+            selected = set(range(len(self.raw_names)))
+        if exclude:
+            for pattern in exclude:
+                selected -= self._trie.match(pattern)
+        return sorted(selected)
 
-            assert(idf.tell() == total_uncomp_size)
+    def chunk_digests(self):
+        """
+        Returns a list of SHA-1 digests of each chunk's compressed data
+        (computed the first time they're asked for).  Nothing gets
+        decompressed in the process.
+        """
+        if self._chunk_digests is None:
+            self._chunk_digests = []
+            with self._open() as df:
+                df.seek(self.data_offset)
+                for _, comp_size, _, _ in self.chunks:
+                    self._chunk_digests.append(hashlib.sha1(df.read(comp_size)).digest())
+        return self._chunk_digests
+
+    def _same_chunks(self, other, offset, other_offset, length):
+        """
+        Returns `True` if the given range of uncompressed data is known to be
+        identical between this archive and `other`, because it's at the same
+        offset in both, and is covered by chunks whose compressed data is
+        identical.  A `False` return just means we'd have to decompress the
+        data to find out.
+        """
+        if length == 0:
+            return True
+        if offset != other_offset:
+            return False
+        first = bisect.bisect_right(self._chunk_starts, offset) - 1
+        last = bisect.bisect_right(self._chunk_starts, offset + length - 1) - 1
+        if last >= len(other.chunks):
+            return False
+        for chunk_idx in range(first, last+1):
+            if self.chunks[chunk_idx][1:] != other.chunks[chunk_idx][1:]:
+                return False
+            if self.chunk_digests()[chunk_idx] != other.chunk_digests()[chunk_idx]:
+                return False
+        return True
+
+    def _file_digests(self, indexes):
+        """
+        Returns a dict mapping each of the given file indexes to a SHA-1
+        digest of that file's contents
+        """
+        digests = {}
+        for idx, (_, contents) in zip(indexes, self.iter_files(indexes)):
+            digests[idx] = hashlib.sha1(contents).digest()
+        return digests
+
+    def diff(self, other, include=None, exclude=None):
+        """
+        Compares this archive to `other`, returning a tuple of three sorted
+        lists of filenames: files only found in `other` (added), files only
+        found in this archive (removed), and files whose contents differ
+        (modified).  `include` and `exclude` can be used to restrict the
+        comparison, as with `select()`.
+
+        Files are compared by size first.  Files of the same size are
+        considered identical without decompressing anything if they're
+        covered by identical compressed chunks in both archives, and are
+        otherwise decompressed and hashed.  Lazy archives will only
+        decompress the chunks needed to do so.
+        """
+        ours = {self.entry_name(idx): idx for idx in self.select(include, exclude)}
+        theirs = {other.entry_name(idx): idx for idx in other.select(include, exclude)}
+        added = sorted(theirs.keys() - ours.keys())
+        removed = sorted(ours.keys() - theirs.keys())
+
+        modified = []
+        to_hash = []
+        for filename in ours.keys() & theirs.keys():
+            idx = ours[filename]
+            other_idx = theirs[filename]
+            length = self.lengths[idx]
+            if length != other.lengths[other_idx]:
+                modified.append(filename)
+            elif not self._same_chunks(other, self.offsets[idx], other.offsets[other_idx], length):
+                to_hash.append((idx, other_idx))
+        if self.verbose:
+            print('Hashing {} files to compare'.format(len(to_hash)))
+
+        if to_hash:
+            our_digests = self._file_digests(sorted(idx for idx, _ in to_hash))
+            their_digests = other._file_digests(sorted(other_idx for _, other_idx in to_hash))
+            for idx, other_idx in to_hash:
+                if our_digests[idx] != their_digests[other_idx]:
+                    modified.append(self.entry_name(idx))
+        modified.sort()
+
+        return (added, removed, modified)
+
+    def find(self, filename):
+        """
+        Returns the index of the specified file (using the stripped filename,
+        as reported by iterating over the archive), or raises a `KeyError`
+        if it doesn't exist.  The lookup table is only built the first time
+        it's needed.
+        """
+        if self._lookup is None:
+            self._lookup = {name: idx for idx, name in enumerate(self.filenames())}
+        return self._lookup[filename]
+
+    def __contains__(self, filename):
+        try:
+            self.find(filename)
+            return True
+        except KeyError:
+            return False
+
+    def read(self, filename):
+        """
+        Returns the contents of the specified file (using the stripped
+        filename, as reported by iterating over the archive).  In lazy
+        mode, only the chunks covering the file will be decompressed.
+        Otherwise, this is a read-only `memoryview` into the decompressed
+        data, which is shared by every caller.
+        """
+        idx = self.find(filename)
+        offset = self.offsets[idx]
+        length = self.lengths[idx]
+        if not self.lazy:
+            return self._data[offset:offset+length]
+        with self._open() as df:
+            return self._read_range(df, offset, length)
 
     def _uint32(self, df):
         """
         Reads a uint32 (four-byte) from the specified file
         """
-        return struct.unpack('<I', df.read(4))[0]
+        return struct.unpack('<I', self._read_exactly(df, 4))[0]
 
     def _ulong64(self, df):
         """
         Reads a ulong64 (eight-byte) from the specified file
         """
-        return struct.unpack('<Q', df.read(8))[0]
+        return struct.unpack('<Q', self._read_exactly(df, 8))[0]
 
     def _str(self, df):
         """
@@ -161,19 +1047,7 @@ class TMSArchive:
         parameter in front) from the specified file
         """
         strlen = self._uint32(df)
-        return df.read(strlen)[:-1].decode('utf-8')
-
-    def _read_file(self, df):
-        """
-        Read a file entry from the specified file.  A string filename
-        should be first, followed by a uint32 size of the file, followed
-        by the file contents.  Will return a tuple of the filename and
-        contents.
-        """
-        filename = self._str(df)
-        contents_len = self._uint32(df)
-        contents = df.read(contents_len)
-        return (filename, contents)
+        return self._read_exactly(df, strlen)[:-1].decode('utf-8')
 
     def _finish(self):
         """
@@ -186,7 +1060,7 @@ class TMSArchive:
         # Find the common prefix (though we're only stripping out `..`s)
         prefixes = []
         max_idx = -1
-        for idx, component in enumerate(zip(*[k.split('/') for k in self.files.keys()])):
+        for idx, component in enumerate(zip(*[k.split('/') for k in self.raw_names])):
             if not all([p == '..' for p in component]):
                 max_idx = idx
                 break
@@ -199,21 +1073,670 @@ class TMSArchive:
 
         # If there are any files with `..` left in them, after stripping
         # off the common prefixes, abort.  Don't want to have to cope
-        # with dealing with extractions which have relative paths.
-        new_files = {}
-        for filename, contents in self.files.items():
-            new_filename = filename[len(self.common_prefix):]
+        # with dealing with extractions which have relative paths.  The
+        # stripped filenames themselves are only generated as needed.
+        for new_filename in self.filenames():
             if '../' in new_filename:
                 raise RuntimeError('Relative path not allowed in stripped filename: {}'.format(new_filename))
-            new_files[new_filename] = contents
-        self.files = new_files
 
     def __len__(self):
-        return len(self.files)
+        if self.stream:
+            return self.filecount
+        return len(self.raw_names)
+
+    @property
+    def files(self):
+        """
+        A dict mapping each filename to its contents, for compatibility with
+        code written before the `files` dict went away.  This is built from
+        scratch (reading every file) each time it's accessed, so prefer
+        `read()` or iterating over the archive.
+        """
+        return dict(self)
 
     def __iter__(self):
-        for i in self.files.items():
-            yield i
+        if self.stream:
+            yield from self._iter_stream()
+        else:
+            yield from self.iter_files(range(len(self.raw_names)))
+
+    def iter_files(self, indexes):
+        """
+        Yields a tuple of the filename and contents of each of the files
+        at the given indexes (as returned by `select()`).  In lazy mode,
+        only the chunks which contain those files will be decompressed,
+        so long as the indexes are in order.
+        """
+        if self.lazy:
+            with self._open() as df:
+                for idx in indexes:
+                    yield (self.entry_name(idx), self._read_range(df, self.offsets[idx], self.lengths[idx]))
+        else:
+            for idx in indexes:
+                offset = self.offsets[idx]
+                yield (self.entry_name(idx), self._data[offset:offset+self.lengths[idx]])
+
+def _inflate_chunk(comp_data, uncomp_size):
+    """
+    Inflates a single compressed chunk for `verify_archive`, returning a
+    tuple of the decompressed data and an error message (or `None`).  The
+    zlib stream must be complete, with no trailing data, and decompress to
+    exactly `uncomp_size` bytes.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(comp_data, uncomp_size + 1)
+    except zlib.error as e:
+        return (None, 'zlib error: {}'.format(e))
+    if len(data) > uncomp_size:
+        return (None, 'decompressed to more than {} bytes'.format(uncomp_size))
+    if not decompressor.eof:
+        return (None, 'zlib stream is incomplete (decompressed to {} of {} bytes)'.format(len(data), uncomp_size))
+    if len(data) < uncomp_size:
+        return (None, 'only decompressed to {} of {} bytes'.format(len(data), uncomp_size))
+    if decompressor.unused_data:
+        return (None, '{} bytes of trailing data after zlib stream'.format(len(decompressor.unused_data)))
+    return (data, None)
+
+class _EntryWalker:
+    """
+    Walks the file entry headers in a TMS archive's uncompressed data as it
+    gets fed in, chunk by chunk, for `verify_archive`.  Only the entry
+    headers themselves are ever copied anywhere; file contents are just
+    skipped over.  Raises a `RuntimeError` describing the first bad entry.
+    """
+
+    # Longest filename we'll accept, so a corrupt length can't have us
+    # buffering up the whole archive
+    MAX_FILENAME_LENGTH = 65536
+
+    def __init__(self, filecount, total_uncomp_size):
+        self.filecount = filecount
+        self.total_uncomp_size = total_uncomp_size
+        self.entries = 0
+        self.offset = 0
+        self.entry_offset = 0
+        self.header = bytearray()
+        self.strlen = None
+        self.skip = 0
+
+    def _error(self, message):
+        raise RuntimeError('entry {} (at uncompressed offset {}): {}'.format(
+            self.entries, self.entry_offset, message))
+
+    def _take(self, data, pos, length):
+        """
+        Adds up to `length` bytes of `data` (starting at `pos`) to our
+        header buffer, returning the new position in `data`
+        """
+        needed = length - len(self.header)
+        self.header += data[pos:pos+needed]
+        return min(len(data), pos + needed)
+
+    def feed(self, data):
+        pos = 0
+        while pos < len(data):
+            if self.skip:
+                skipped = min(self.skip, len(data) - pos)
+                self.skip -= skipped
+                pos += skipped
+                if self.skip == 0:
+                    self.entries += 1
+                continue
+            if self.entries >= self.filecount:
+                self._error('data found past the last of {} files'.format(self.filecount))
+            if self.strlen is None:
+                if not self.header:
+                    self.entry_offset = self.offset + pos
+                pos = self._take(data, pos, 4)
+                if len(self.header) < 4:
+                    continue
+                self.strlen = struct.unpack('<I', self.header)[0]
+                self.header.clear()
+                if self.strlen < 2 or self.strlen > self.MAX_FILENAME_LENGTH \
+                        or self.entry_offset + 8 + self.strlen > self.total_uncomp_size:
+                    self._error('invalid filename length {}'.format(self.strlen))
+                continue
+            pos = self._take(data, pos, self.strlen + 4)
+            if len(self.header) < self.strlen + 4:
+                continue
+            name = bytes(self.header[:self.strlen])
+            if name[-1:] != b"\00":
+                self._error('filename is not null-terminated')
+            try:
+                name[:-1].decode('utf-8')
+            except UnicodeDecodeError as e:
+                self._error('filename is not valid UTF-8: {}'.format(e))
+            length = struct.unpack('<I', self.header[self.strlen:])[0]
+            self.header.clear()
+            self.strlen = None
+            if self.entry_offset + 8 + len(name) + length > self.total_uncomp_size:
+                self._error('file length {} runs past the end of the data'.format(length))
+            if length == 0:
+                self.entries += 1
+            self.skip = length
+        self.offset += len(data)
+
+    def finish(self):
+        if self.header or self.strlen is not None or self.skip:
+            self._error('data ends partway through the entry')
+        if self.entries != self.filecount:
+            raise RuntimeError('found {} files, but the header says there should be {}'.format(
+                self.entries, self.filecount))
+
+def verify_archive(filename, jobs=1):
+    """
+    Checks the integrity of a TMS archive (anything that `TMSArchive`
+    accepts, aside from non-seekable streams) without ever holding more
+    than a few chunks of it in memory: the header, the chunk table (and
+    that it adds up to the sizes in the header), the footer, each chunk's
+    zlib stream, and the file entry headers in the decompressed data.
+    Chunks are inflated in a thread pool, `jobs` at a time.
+
+    Raises a `RuntimeError` describing the first problem found, including
+    which chunk or file entry it's in and its offset.  Otherwise, returns
+    a dict with some info about the archive.  That includes the number of
+    `short_chunks`: chunks other than the last which are smaller than the
+    archive's chunk size.  We can read those fine, but the game itself may
+    not be able to.
+    """
+    if isinstance(filename, (str, os.PathLike)):
+        df = open(filename, 'rb')
+    elif isinstance(filename, (bytes, bytearray, memoryview)):
+        df = io.BytesIO(filename)
+    else:
+        df = filename
+    with contextlib.ExitStack() as stack:
+        if df is not filename:
+            stack.enter_context(df)
+        total_size = df.seek(0, io.SEEK_END)
+        df.seek(0)
+
+        # Header
+        header_size = TMSArchive.HEADER_SIZE
+        header = df.read(header_size)
+        if len(header) < header_size:
+            raise RuntimeError('header (at offset 0): file is only {} bytes long'.format(total_size))
+        total_uncomp_size, filecount, magic, chunk_size, total_comp_size, total_uncomp_size_64 = \
+                struct.unpack('<IIQQQQ', header)
+        if magic != 0x9E2A83C1:
+            raise RuntimeError('header (at offset 8): bad magic number 0x{:X}'.format(magic))
+        if total_uncomp_size != total_uncomp_size_64:
+            raise RuntimeError('header (at offset 32): uncompressed size {} does not match {} (at offset 0)'.format(
+                total_uncomp_size_64, total_uncomp_size))
+        if chunk_size == 0:
+            raise RuntimeError('header (at offset 16): chunk size is zero')
+
+        # Chunk table
+        chunks = []
+        cur_comp_size = 0
+        cur_uncomp_size = 0
+        while cur_comp_size < total_comp_size:
+            table_offset = header_size + len(chunks)*16
+            entry = df.read(16)
+            if len(entry) < 16:
+                raise RuntimeError('chunk table entry {} (at offset {}): file ends partway through the chunk table'.format(
+                    len(chunks), table_offset))
+            comp_size, uncomp_size = struct.unpack('<QQ', entry)
+            if comp_size == 0 or uncomp_size == 0 or uncomp_size > chunk_size:
+                raise RuntimeError('chunk table entry {} (at offset {}): invalid sizes (compressed {}, uncompressed {})'.format(
+                    len(chunks), table_offset, comp_size, uncomp_size))
+            chunks.append((comp_size, uncomp_size))
+            cur_comp_size += comp_size
+            cur_uncomp_size += uncomp_size
+        if cur_comp_size != total_comp_size:
+            raise RuntimeError('chunk table (at offset {}): compressed sizes add up to {}, not {}'.format(
+                header_size, cur_comp_size, total_comp_size))
+        if cur_uncomp_size != total_uncomp_size:
+            raise RuntimeError('chunk table (at offset {}): uncompressed sizes add up to {}, not {}'.format(
+                header_size, cur_uncomp_size, total_uncomp_size))
+        data_offset = header_size + len(chunks)*16
+        footer_offset = data_offset + total_comp_size
+        if footer_offset > total_size:
+            raise RuntimeError('compressed data (at offset {}): file ends {} bytes early'.format(
+                data_offset, footer_offset - total_size))
+
+        # Footer
+        df.seek(footer_offset)
+        footer = df.read()
+        try:
+            pos = 4
+            for _ in range(struct.unpack_from('<I', footer, 0)[0]):
+                strlen = struct.unpack_from('<I', footer, pos)[0]
+                pos += 4 + strlen
+            pos += 8
+        except struct.error:
+            pos = len(footer) + 1
+        if pos != len(footer):
+            raise RuntimeError('footer (at offset {}): invalid footer'.format(footer_offset))
+
+        # Chunks and file entries.  Compressed chunks are read in order and
+        # inflated `jobs` at a time, and their data is handed to the entry
+        # walker and then thrown away.
+        walker = _EntryWalker(filecount, total_uncomp_size)
+        df.seek(data_offset)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            pending = collections.deque()
+            comp_offset = data_offset
+            for chunk_idx, (comp_size, uncomp_size) in enumerate(chunks):
+                pending.append((chunk_idx, comp_offset, executor.submit(_inflate_chunk, df.read(comp_size), uncomp_size)))
+                comp_offset += comp_size
+                while pending and (len(pending) >= jobs or chunk_idx == len(chunks) - 1):
+                    done_idx, done_offset, future = pending.popleft()
+                    data, error = future.result()
+                    if error is not None:
+                        for _, _, other in pending:
+                            other.cancel()
+                        raise RuntimeError('chunk {} (at offset {}): {}'.format(done_idx, done_offset, error))
+                    walker.feed(data)
+        walker.finish()
+
+    return {
+            'size': total_size,
+            'files': filecount,
+            'chunks': len(chunks),
+            'compressed': total_comp_size,
+            'uncompressed': total_uncomp_size,
+            'short_chunks': sum(1 for _, uncomp_size in chunks[:-1] if uncomp_size < chunk_size),
+            }
+
+def patch_archive(archive, replacements, jobs=1, uniform=True):
+    """
+    Builds a new version of `archive` (a lazy `TMSArchive`) in memory, with
+    the contents of the files in `replacements` (a dict mapping filenames,
+    as returned by `filenames()`, to their new contents) replaced.  Returns
+    a tuple of the new archive data, and the number of chunks which had to
+    be recompressed (in a thread pool, `jobs` at a time).
+
+    Everything from the first replaced file onwards is re-chunked at the
+    archive's chunk size, so the result is laid out just like a freshly
+    packed archive.  Chunks before that (and any later chunk whose data
+    ends up unchanged) keep their compressed data verbatim.  If a file's
+    size changes, that means recompressing everything after it.  If
+    `uniform` is `False`, only the chunks covering the replaced files are
+    re-chunked instead, which can leave chunks smaller than the chunk size
+    in the middle of the archive.  We can read those fine, but the game
+    itself may not be able to.
+    """
+    assert(archive.lazy)
+    edits = []
+    for filename, contents in replacements.items():
+        idx = archive.find(filename)
+        edits.append((archive.offsets[idx], archive.lengths[idx], contents))
+    edits.sort(key=lambda edit: edit[0])
+
+    # Figure out which runs of chunks each edit touches (including the
+    # length field in front of the file), merging any that overlap
+    regions = []
+    for offset, length, contents in edits:
+        first = bisect.bisect_right(archive._chunk_starts, offset - 4) - 1
+        if uniform:
+            last = len(archive.chunks) - 1
+        else:
+            last = bisect.bisect_right(archive._chunk_starts, offset + length - 1) - 1
+        if regions and first <= regions[-1][1]:
+            regions[-1][1] = max(last, regions[-1][1])
+            regions[-1][2].append((offset, length, contents))
+        else:
+            regions.append([first, last, [(offset, length, contents)]])
+
+    new_chunks = []
+    recompressed = 0
+    with archive._open() as df, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+
+        def copy_chunk(chunk_idx):
+            comp_offset, comp_size, _, uncomp_size = archive.chunks[chunk_idx]
+            df.seek(comp_offset)
+            new_chunks.append((df.read(comp_size), uncomp_size))
+
+        chunk_idx = 0
+        for first, last, region_edits in regions:
+            while chunk_idx < first:
+                copy_chunk(chunk_idx)
+                chunk_idx += 1
+
+            # Splice the new file contents into the region's data
+            region_start = archive.chunks[first][2]
+            region_end = archive.chunks[last][2] + archive.chunks[last][3]
+            old_data = archive._read_range(df, region_start, region_end - region_start)
+            parts = []
+            pos = region_start
+            for offset, length, contents in region_edits:
+                parts.append(old_data[pos-region_start:offset-4-region_start])
+                parts.append(struct.pack('<I', len(contents)))
+                parts.append(contents)
+                pos = offset + length
+            parts.append(old_data[pos-region_start:])
+            new_data = b''.join(parts)
+
+            # Re-chunk it, reusing any chunk which hasn't changed
+            for span_start in range(0, len(new_data), archive.chunk_size):
+                span = new_data[span_start:span_start+archive.chunk_size]
+                old_idx = first + span_start // archive.chunk_size
+                if old_idx <= last \
+                        and archive.chunks[old_idx][2] - region_start == span_start \
+                        and archive.chunks[old_idx][3] == len(span) \
+                        and old_data[span_start:span_start+len(span)] == span:
+                    copy_chunk(old_idx)
+                else:
+                    new_chunks.append((executor.submit(zlib.compress, span), len(span)))
+                    recompressed += 1
+            chunk_idx = last + 1
+
+        while chunk_idx < len(archive.chunks):
+            copy_chunk(chunk_idx)
+            chunk_idx += 1
+
+        df.seek(archive.data_offset + archive.total_comp_size)
+        footer = df.read()
+        new_chunks = [(c.result() if isinstance(c, concurrent.futures.Future) else c, uncomp_size)
+                for c, uncomp_size in new_chunks]
+
+    # ... and put it all together
+    total_comp_size = sum(len(c) for c, _ in new_chunks)
+    total_uncomp_size = sum(uncomp_size for _, uncomp_size in new_chunks)
+    out = io.BytesIO()
+    out.write(struct.pack('<IIQQQQ',
+        total_uncomp_size,
+        archive.filecount,
+        0x9E2A83C1,
+        archive.chunk_size,
+        total_comp_size,
+        total_uncomp_size,
+        ))
+    for chunk_data, uncomp_size in new_chunks:
+        out.write(struct.pack('<QQ', len(chunk_data), uncomp_size))
+    for chunk_data, _ in new_chunks:
+        out.write(chunk_data)
+    out.write(footer)
+    return (out.getvalue(), recompressed)
+
+def replace_file(full_filename, contents):
+    """
+    Writes `contents` out to `full_filename` by way of a temp file which
+    then replaces it.  If `full_filename` was a hardlink (into a
+    content-addressed store, say), the link gets broken, rather than the
+    new contents being written through to every other copy of the file.
+    """
+    temp_filename = '{}.tmp{}'.format(full_filename, os.getpid())
+    try:
+        with open(temp_filename, 'wb') as odf:
+            odf.write(contents)
+        os.replace(temp_filename, full_filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_filename)
+        raise
+
+def sync_file(full_filename, contents):
+    """
+    Writes `contents` out to `full_filename`, unless the file already
+    exists with identical contents.  Existing files are compared by size
+    first, and their contents only read in if the size matches.  Returns
+    `added`, `changed`, or `unchanged`, depending on what was done.
+    """
+    try:
+        size = os.path.getsize(full_filename)
+    except FileNotFoundError:
+        status = 'added'
+    else:
+        if size == len(contents):
+            with open(full_filename, 'rb') as df:
+                if df.read() == contents:
+                    return 'unchanged'
+        status = 'changed'
+    os.makedirs(os.path.dirname(full_filename), exist_ok=True)
+    replace_file(full_filename, contents)
+    return status
+
+def store_file(store, contents):
+    """
+    Stores `contents` in the content-addressed store directory `store`,
+    under the SHA-1 hash of the contents, unless it's already there.
+    Returns a tuple of the path to the stored file, and whether or not it
+    actually had to be stored.  Files are written atomically, and never
+    replaced once they're in the store, so several processes can safely
+    share a store.  Stored files are made read-only, since everything
+    linked to them shares their contents.
+    """
+    digest = hashlib.sha1(contents).hexdigest()
+    store_filename = os.path.join(store, digest[:2], digest[2:])
+    if os.path.exists(store_filename):
+        return (store_filename, False)
+    os.makedirs(os.path.dirname(store_filename), exist_ok=True)
+    temp_filename = '{}.tmp{}'.format(store_filename, os.getpid())
+    with open(temp_filename, 'wb') as odf:
+        odf.write(contents)
+    os.chmod(temp_filename, 0o444)
+    # Linking (rather than renaming) the temp file into place means that
+    # if another process beat us to it, we find out, and their copy (which
+    # may already have been linked to) is left alone.
+    try:
+        os.link(temp_filename, store_filename)
+        stored = True
+    except FileExistsError:
+        stored = False
+    except OSError:
+        os.replace(temp_filename, store_filename)
+        return (store_filename, True)
+    os.unlink(temp_filename)
+    return (store_filename, stored)
+
+def link_file(store_filename, full_filename):
+    """
+    Hardlinks `full_filename` to the given file in a content-addressed
+    store, replacing whatever was there before.  If hardlinks aren't
+    possible (for instance if the store is on a different filesystem),
+    the file is copied instead.  Returns `added`, `changed`, or
+    `unchanged`, depending on what was done.
+    """
+    try:
+        if os.path.samefile(store_filename, full_filename):
+            return 'unchanged'
+        os.unlink(full_filename)
+        status = 'changed'
+    except FileNotFoundError:
+        status = 'added'
+    os.makedirs(os.path.dirname(full_filename), exist_ok=True)
+    try:
+        os.link(store_filename, full_filename)
+    except OSError:
+        shutil.copyfile(store_filename, full_filename)
+    return status
+
+def extract_to_store(filename, extract_dir, store, include=None, exclude=None, jobs=1):
+    """
+    Extracts the archive `filename` into `extract_dir`, storing each file's
+    contents only once in the content-addressed store `store`, with the
+    extracted files being hardlinks into it.  `include` and `exclude` are
+    used to select files, as with `TMSArchive.select`.  Returns a Counter
+    of the number of files `added`, `changed`, or `unchanged` in the tree,
+    and the number which were `stored` (ie: weren't already in the store).
+    Meant to be run in a worker process, for batch extractions.
+    """
+    counts = collections.Counter()
+    if include or exclude:
+        tms = TMSArchive(filename, lazy=True, jobs=jobs)
+        files = tms.iter_files(tms.select(include, exclude))
+    else:
+        files = TMSArchive(filename, stream=True, jobs=jobs)
+    for int_filename, contents in files:
+        store_filename, stored = store_file(store, contents)
+        if stored:
+            counts['stored'] += 1
+        counts[link_file(store_filename, '/'.join([extract_dir, int_filename]))] += 1
+    return counts
+
+class Fetcher:
+    """
+    Fetches TMS archives over HTTP(S).  One connection is kept open per host
+    and reused for every request, and the `ETag` and `Last-Modified` headers
+    of each archive are remembered (in `state`, which is loaded from and
+    saved to `state_file`, if given), so that archives which haven't changed
+    since we last fetched them can be skipped with a single conditional
+    request, without downloading anything.
+    """
+
+    # Maximum number of redirects to follow for a single fetch
+    MAX_REDIRECTS = 5
+
+    def __init__(self, state_file=None, timeout=30):
+        self.state_file = state_file
+        self.timeout = timeout
+        self.state = {}
+        self._connections = {}
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file, 'r', encoding='utf-8') as df:
+                    self.state = json.load(df)
+            except (OSError, ValueError):
+                self.state = {}
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save(self):
+        """
+        Writes our remembered `ETag`/`Last-Modified` headers out to our
+        state file (if we have one)
+        """
+        if not self.state_file:
+            return
+        temp_filename = '{}.tmp{}'.format(self.state_file, os.getpid())
+        with open(temp_filename, 'w', encoding='utf-8') as odf:
+            json.dump(self.state, odf, indent=2)
+        os.replace(temp_filename, self.state_file)
+
+    def _connection(self, parts, fresh=False):
+        """
+        Returns our pooled connection for the host of the given (split)
+        URL, opening a new one if we don't have one yet, or if `fresh` is
+        `True`
+        """
+        key = (parts.scheme, parts.netloc)
+        conn = self._connections.pop(key, None)
+        if conn is not None and fresh:
+            conn.close()
+            conn = None
+        if conn is None:
+            if parts.scheme == 'https':
+                conn = http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+            elif parts.scheme == 'http':
+                conn = http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+            else:
+                raise RuntimeError('Unsupported URL scheme: {}'.format(parts.scheme))
+        self._connections[key] = conn
+        return conn
+
+    def _drop_connection(self, parts):
+        """
+        Closes and forgets our connection for the host of the given (split)
+        URL, such as when a response wasn't read in full
+        """
+        conn = self._connections.pop((parts.scheme, parts.netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def _request(self, parts, headers):
+        """
+        Sends a GET request for the given (split) URL over our pooled
+        connection, and returns the response.  If the server had closed
+        the connection since our last request, we'll reconnect once.  Any
+        other error (such as a timeout) drops the connection, since it may
+        be left partway through a request, which would break every later
+        request to the same host.
+        """
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        for attempt in range(2):
+            conn = self._connection(parts, fresh=attempt > 0)
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                self._drop_connection(parts)
+                if attempt > 0:
+                    raise
+            except BaseException:
+                self._drop_connection(parts)
+                raise
+
+    def _finish_response(self, parts, response):
+        """
+        Reads the rest of the given response, so that its connection can
+        be reused.  If that fails, the connection gets dropped.
+        """
+        try:
+            response.read()
+        except BaseException:
+            self._drop_connection(parts)
+            raise
+
+    @contextlib.contextmanager
+    def fetch(self, url):
+        """
+        Context manager which requests the given URL, yielding the HTTP
+        response (a non-seekable file-like object, which can be passed
+        straight to a streaming `TMSArchive`) if the archive has changed
+        since we last fetched it, or `None` if it hasn't.  The new `ETag`
+        and `Last-Modified` headers are only remembered if the block
+        completes without an exception, so a failed fetch gets retried
+        next time.
+        """
+        headers = {}
+        validators = self.state.get(url, {})
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        request_url = url
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(request_url)
+            response = self._request(parts, headers)
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+            location = response.getheader('Location')
+            self._finish_response(parts, response)
+            if not location:
+                raise RuntimeError('HTTP {} with no Location fetching {}'.format(response.status, request_url))
+            request_url = urllib.parse.urljoin(request_url, location)
+        else:
+            raise RuntimeError('Too many redirects fetching {}'.format(url))
+
+        if response.status == 304:
+            self._finish_response(parts, response)
+            yield None
+            return
+        if response.status != 200:
+            # No sense downloading whatever error page we got, so this
+            # connection can't be reused
+            self._drop_connection(parts)
+            raise RuntimeError('HTTP {} {} fetching {}'.format(response.status, response.reason, request_url))
+
+        try:
+            yield response
+            # Make sure the connection is ready for its next request
+            response.read()
+        except BaseException:
+            self._drop_connection(parts)
+            raise
+        validators = {}
+        if response.getheader('ETag'):
+            validators['etag'] = response.getheader('ETag')
+        if response.getheader('Last-Modified'):
+            validators['last_modified'] = response.getheader('Last-Modified')
+        self.state[url] = validators
 
 if __name__ == '__main__':
 
@@ -238,38 +1761,261 @@ if __name__ == '__main__':
             help='Force overwrite of file contents (will prompt, otherwise)',
             )
 
+    parser.add_argument('-s', '--sync',
+            action='store_true',
+            help='Only write files which are missing or have changed on disk (implies --force), using a thread pool',
+            )
+
     parser.add_argument('-d', '--directory',
             type=str,
             help='Directory to extract to (will default to the base filename of the OakTMS file)',
             )
 
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of threads to use while decompressing (defaults to the number of CPUs)',
+            )
+
+    parser.add_argument('--include',
+            type=str,
+            action='append',
+            metavar='PATTERN',
+            help='Only list/extract files matching this glob pattern (`**` matches any number of directories).  May be specified more than once.  With --index-cache, only the chunks containing the selected files get decompressed',
+            )
+
+    parser.add_argument('--exclude',
+            type=str,
+            action='append',
+            metavar='PATTERN',
+            help='Skip files matching this glob pattern.  May be specified more than once',
+            )
+
+    parser.add_argument('--diff',
+            type=str,
+            metavar='OTHER',
+            help='Compare the archive to another OakTMS file, and report files which were added (A), removed (D), or modified (M) in OTHER.  Exits with status 1 if there are any differences',
+            )
+
+    parser.add_argument('-i', '--index-cache',
+            action='store_true',
+            help='Use (and create) a sidecar index file alongside the archive, to speed up repeated listings',
+            )
+
+    parser.add_argument('--stats',
+            type=str,
+            metavar='STATS_FILE',
+            help='Write JSON timing, throughput, and memory statistics for each phase of processing to STATS_FILE (or to stderr, if `-`, so it stays separate from the normal output)',
+            )
+
+    parser.add_argument('--store',
+            type=str,
+            metavar='STORE',
+            help='Batch mode: extract any number of archives (in parallel, using --jobs processes), storing each distinct file only once in the content-addressed STORE directory, and building each archive\'s tree out of hardlinks into it.  Each tree goes in a directory named after its archive, inside --directory if given (or alongside the archive, otherwise)',
+            )
+
+    parser.add_argument('--fetch',
+            action='store_true',
+            help='Treat the filenames as HTTP(S) URLs, and sync each archive which has changed since it was last fetched into a directory named after its URL path (inside --directory, if given).  Archives are decoded while they download, and unchanged archives are skipped with a single conditional request',
+            )
+
+    parser.add_argument('--fetch-state',
+            type=str,
+            metavar='STATE_FILE',
+            help='File to remember the ETag/Last-Modified headers of fetched archives in (defaults to `.oaktms-fetch.json` inside --directory, or the current directory)',
+            )
+
+    parser.add_argument('--verify',
+            action='store_true',
+            help='Only check the integrity of the archive(s): the header, chunk table, footer, every chunk\'s zlib stream, and the file entries, stopping at the first error.  Chunks are inflated --jobs at a time, and never all held in memory.  Exits with status 1 if any archive fails',
+            )
+
     parser.add_argument('filename',
-            nargs=1,
-            help='OakTMS file to parse',
+            nargs='+',
+            help='OakTMS file to parse (more than one may be given, with --store, --fetch, or --verify)',
             )
 
     # Parse args
     args = parser.parse_args()
+    if len(args.filename) > 1 and not args.store and not args.fetch and not args.verify:
+        parser.error('only one filename may be given, unless using --store, --fetch, or --verify')
+    if args.fetch and (args.store or args.list or args.diff or args.include or args.exclude):
+        parser.error('--fetch cannot be combined with --store, --list, --diff, --include, or --exclude')
     filename = args.filename[0]
     verbose = args.verbose >= 1
     debug = args.verbose >= 2
     force = args.force
     extract_dir = args.directory
+    exit_status = 0
+    if args.stats:
+        stats = Stats('oaktms')
+    else:
+        stats = None
+
+    # Verify mode
+    if args.verify:
+        for verify_filename in args.filename:
+            try:
+                with stats_phase(stats, 'verify'):
+                    info = verify_archive(verify_filename, jobs=args.jobs)
+            except (RuntimeError, OSError) as e:
+                print('ERROR: {}: {}'.format(verify_filename, e))
+                exit_status = 1
+                continue
+            print('OK: {} ({} files in {} chunks, {} bytes uncompressed)'.format(
+                verify_filename,
+                info['files'],
+                info['chunks'],
+                info['uncompressed'],
+                ))
+            if info['short_chunks']:
+                print('WARNING: {}: {} chunk(s) before the last are smaller than the chunk size, which the game may not accept'.format(
+                    verify_filename,
+                    info['short_chunks'],
+                    ))
+        if stats is not None:
+            stats.write(args.stats)
+        sys.exit(exit_status)
 
-    # Process the archive
-    tms = TMSArchive(filename, verbose=debug)
+    # Batch mode.  Each archive is extracted in its own worker process,
+    # with files being written into the store only the first time we've
+    # seen their contents.
+    if args.store:
+        batch = []
+        for batch_filename in args.filename:
+            batch_dir, ext = os.path.splitext(batch_filename)
+            if args.directory:
+                batch_dir = os.path.join(args.directory, os.path.basename(batch_dir))
+            if batch_dir == batch_filename or batch_dir in [b[1] for b in batch]:
+                print('ERROR: Could not find a unique extraction dir for {}'.format(batch_filename))
+                sys.exit(1)
+            batch.append((batch_filename, batch_dir))
+        totals = collections.Counter()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(extract_to_store,
+                batch_filename,
+                batch_dir,
+                args.store,
+                args.include,
+                args.exclude,
+                ) for batch_filename, batch_dir in batch]
+            for (batch_filename, batch_dir), future in zip(batch, futures):
+                with stats_phase(stats, 'batch'):
+                    counts = future.result()
+                totals += counts
+                print('Extracted {} to {}: {} added, {} changed, {} unchanged, {} new in store'.format(
+                    batch_filename,
+                    batch_dir,
+                    counts['added'],
+                    counts['changed'],
+                    counts['unchanged'],
+                    counts['stored'],
+                    ))
+        num_files = totals['added'] + totals['changed'] + totals['unchanged']
+        print('Extracted {} archives ({} files) to {}: {} files new in store'.format(
+            len(batch),
+            num_files,
+            args.store,
+            totals['stored'],
+            ))
+        if stats is not None:
+            stats.write(args.stats)
+        sys.exit(0)
+
+    # Fetch mode.  Each archive which has changed gets streamed straight
+    # from the HTTP response into the decoder, and synced to disk.
+    if args.fetch:
+        base_dir = args.directory or '.'
+        state_file = args.fetch_state or os.path.join(base_dir, '.oaktms-fetch.json')
+        with Fetcher(state_file) as fetcher:
+            for url in args.filename:
+                try:
+                    with fetcher.fetch(url) as response:
+                        if response is None:
+                            print('Unchanged: {}'.format(url))
+                            continue
+                        url_path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+                        fetch_dir = os.path.join(base_dir, os.path.splitext(url_path.strip('/'))[0])
+                        if '..' in fetch_dir.split(os.sep) or os.path.normpath(fetch_dir) == os.path.normpath(base_dir):
+                            raise RuntimeError('Could not find a safe extraction dir for {}'.format(url))
+                        counts = collections.Counter()
+                        for int_filename, contents in TMSArchive(response, verbose=debug, stream=True, jobs=args.jobs, stats=stats):
+                            full_filename = '/'.join([fetch_dir, int_filename])
+                            with stats_phase(stats, 'write', len(contents)):
+                                status = sync_file(full_filename, contents)
+                            counts[status] += 1
+                            if verbose and status != 'unchanged':
+                                print('{} {}'.format(status.capitalize(), full_filename))
+                except (RuntimeError, AssertionError, OSError, http.client.HTTPException, zlib.error) as e:
+                    print('ERROR: Could not fetch {}: {}'.format(url, e))
+                    exit_status = 1
+                    continue
+                print('Fetched {} to {}: {} added, {} changed, {} unchanged'.format(
+                    url,
+                    fetch_dir,
+                    counts['added'],
+                    counts['changed'],
+                    counts['unchanged'],
+                    ))
+                fetcher.save()
+        if stats is not None:
+            stats.write(args.stats)
+        sys.exit(exit_status)
 
-    # List or Extract
-    if args.list:
+    # Process the archive.  Listing only needs the file index, so there's
+    # no need to decompress everything in that case, and if we're filtering
+    # we only want to decompress the chunks containing the selected files.
+    # (Without an index cache, finding the files in the first place means
+    # walking every entry header, which decompresses most chunks anyway.)
+    # A full extraction streams the archive, so files get written while the
+    # rest of the archive is still being decompressed.
+    filtering = bool(args.include or args.exclude)
+    lazy = args.list or filtering or bool(args.diff)
+    tms = TMSArchive(filename,
+            verbose=debug,
+            lazy=lazy,
+            stream=not lazy,
+            jobs=args.jobs,
+            index_cache=args.index_cache,
+            stats=stats,
+            )
+    if filtering:
+        selected = tms.select(args.include, args.exclude)
+        if verbose:
+            print('Selected {} of {} files'.format(len(selected), len(tms)))
+        files = tms.iter_files(selected)
+    else:
+        selected = range(len(tms))
+        files = tms
+
+    # Diff, List, or Extract
+    if args.diff:
+        other = TMSArchive(args.diff,
+                verbose=debug,
+                lazy=True,
+                jobs=args.jobs,
+                index_cache=args.index_cache,
+                stats=stats,
+                )
+        added, removed, modified = tms.diff(other, args.include, args.exclude)
+        for status, filenames in [('A', added), ('D', removed), ('M', modified)]:
+            for int_filename in filenames:
+                print('{} {}'.format(status, int_filename))
+        if verbose:
+            print('')
+            print('{} added, {} removed, {} modified'.format(len(added), len(removed), len(modified)))
+        if added or removed or modified:
+            exit_status = 1
+    elif args.list:
         if verbose:
             print('{} contents:'.format(filename))
             print('')
-            for filename, _ in tms:
-                print(filename)
+            for idx in selected:
+                print(tms.entry_name(idx))
             print('')
         else:
-            for filename, _ in tms:
-                print(filename)
+            for idx in selected:
+                print(tms.entry_name(idx))
     else:
         # Figure out our extraction dir, if needed
         if not extract_dir:
@@ -278,47 +2024,85 @@ if __name__ == '__main__':
                 print('Setting extraction dir to current directory...')
                 extract_dir = '.'
 
-        # Loop through and extract
-        for int_filename, contents in tms:
-            base_dirname, base_filename = os.path.split(int_filename)
-            dirname = '/'.join([extract_dir, base_dirname])
-            full_filename = '/'.join([dirname, base_filename])
-            os.makedirs(dirname, exist_ok=True)
-            if not force and os.path.exists(full_filename):
-                invalid = True
-                skipping = False
-                while invalid:
-                    invalid = False
-                    print('{} already exists - overwrite?'.format(full_filename))
-                    resp = input('[y]es/[N]o/[a]lways/[q]uit> '.format(full_filename)).strip().lower()
-                    if resp == '':
-                        resp = 'n'
-                    else:
-                        resp = resp[0]
-
-                    if resp== 'n':
-                        print('Skipping!')
-                        skipping = True
-                    elif resp == 'q':
-                        print('Exiting!')
-                        sys.exit(1)
-                    elif resp == 'a':
-                        force = True
-                    elif resp == 'y':
-                        pass
-                    else:
-                        print('Invalid input detected, asking again...')
-                        invalid = True
-
-                if skipping:
-                    continue
+        # In sync mode, hand each file off to a thread pool which writes it
+        # only if it's missing or different.  We keep a bounded number of
+        # files in flight, so we don't hold the whole archive in memory.
+        if args.sync:
+            counts = collections.Counter()
+            def sync_one(full_filename, contents):
+                start_wall = time.perf_counter()
+                start_cpu = time.thread_time()
+                status = sync_file(full_filename, contents)
+                if stats is not None:
+                    stats.add('write', time.perf_counter() - start_wall, time.thread_time() - start_cpu, len(contents))
+                return status
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                pending = collections.deque()
+                def finish_one():
+                    full_filename, future = pending.popleft()
+                    status = future.result()
+                    counts[status] += 1
+                    if verbose and status != 'unchanged':
+                        print('{} {}'.format(status.capitalize(), full_filename))
+                for int_filename, contents in files:
+                    full_filename = '/'.join([extract_dir, int_filename])
+                    pending.append((full_filename, executor.submit(sync_one, full_filename, contents)))
+                    if len(pending) >= args.jobs*2:
+                        finish_one()
+                while pending:
+                    finish_one()
+            print('Synced {} to {}: {} added, {} changed, {} unchanged'.format(
+                filename,
+                extract_dir,
+                counts['added'],
+                counts['changed'],
+                counts['unchanged'],
+                ))
+        else:
+            # Loop through and extract
+            for int_filename, contents in files:
+                base_dirname, base_filename = os.path.split(int_filename)
+                dirname = '/'.join([extract_dir, base_dirname])
+                full_filename = '/'.join([dirname, base_filename])
+                os.makedirs(dirname, exist_ok=True)
+                if not force and os.path.exists(full_filename):
+                    invalid = True
+                    skipping = False
+                    while invalid:
+                        invalid = False
+                        print('{} already exists - overwrite?'.format(full_filename))
+                        resp = input('[y]es/[N]o/[a]lways/[q]uit> '.format(full_filename)).strip().lower()
+                        if resp == '':
+                            resp = 'n'
+                        else:
+                            resp = resp[0]
+
+                        if resp== 'n':
+                            print('Skipping!')
+                            skipping = True
+                        elif resp == 'q':
+                            print('Exiting!')
+                            sys.exit(1)
+                        elif resp == 'a':
+                            force = True
+                        elif resp == 'y':
+                            pass
+                        else:
+                            print('Invalid input detected, asking again...')
+                            invalid = True
+
+                    if skipping:
+                        continue
 
-            # Do the actual writing
-            if verbose:
-                print('Writing to {}...'.format(full_filename))
-            with open(full_filename, 'wb') as odf:
-                odf.write(contents)
+                # Do the actual writing
+                if verbose:
+                    print('Writing to {}...'.format(full_filename))
+                with stats_phase(stats, 'write', len(contents)):
+                    replace_file(full_filename, contents)
 
-        # Report
-        print('Extracted {} to {}'.format(filename, extract_dir))
+            # Report
+            print('Extracted {} to {}'.format(filename, extract_dir))
 
+    if stats is not None:
+        stats.write(args.stats)
+    sys.exit(exit_status)
@@ -21,10 +21,16 @@
 import io
 import os
 import sys
+import time
 import zlib
+import random
 import struct
 import argparse
 import datetime
+import tempfile
+import concurrent.futures
+
+from oaktms import TMSArchive, Stats, stats_phase
 
 def tms_sort(s):
     """
@@ -38,6 +44,52 @@ def tms_sort(s):
     return s.replace(f'OakGame{os.path.sep}TMS{os.path.sep}',
             f"OakGame{os.path.sep}\tTMS{os.path.sep}", 1)
 
+# zlib compression strategies which can be chosen on the commandline
+STRATEGIES = {
+        'default': zlib.Z_DEFAULT_STRATEGY,
+        'filtered': zlib.Z_FILTERED,
+        'huffman': zlib.Z_HUFFMAN_ONLY,
+        'rle': zlib.Z_RLE,
+        'fixed': zlib.Z_FIXED,
+        }
+
+def compress_chunk(span, base_chunk=None, level=6, strategy=zlib.Z_DEFAULT_STRATEGY):
+    """
+    Compresses the given uncompressed span with zlib, using the given
+    compression level and strategy.  If `base_chunk` is passed in, it
+    should be the compressed data for the same chunk from a previous
+    archive, and will be returned as-is if it decompresses to exactly the
+    same data (decompression being much cheaper than compression).
+    """
+    if base_chunk is not None and zlib.decompress(base_chunk) == span:
+        return base_chunk
+    if strategy == zlib.Z_DEFAULT_STRATEGY:
+        return zlib.compress(span, level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+    return compressor.compress(span) + compressor.flush()
+
+def compress_chunks(spans, jobs=1, base_chunks=None, level=6, strategy=zlib.Z_DEFAULT_STRATEGY):
+    """
+    Compresses each of the given uncompressed spans with zlib, returning a
+    list of the compressed data in the same order.  If `jobs` is more than
+    one, the compression happens in a thread pool (zlib releases the GIL
+    while it works); the output is identical either way.  `base_chunks`
+    may contain previously-compressed data to reuse for each span (or
+    `None`), as per `compress_chunk`.
+    """
+    if base_chunks is None:
+        base_chunks = [None]*len(spans)
+    levels = [level]*len(spans)
+    strategies = [strategy]*len(spans)
+    if jobs > 1 and len(spans) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(compress_chunk, spans, base_chunks, levels, strategies))
+    else:
+        return [compress_chunk(*args) for args in zip(spans, base_chunks, levels, strategies)]
+
+# Size of the TMS header, before the chunk table: two uint32s and four ulong64s
+HEADER_SIZE = 4*2 + 8*4
+
 class DataFile:
     """
     Class to wrap some of our data-writing functions into.
@@ -108,6 +160,322 @@ class DataFile:
         self.uint32(len(data))
         self.df.write(data)
 
+class ChunkWriter:
+    """
+    File-like object which accepts uncompressed TMS data, cuts it into
+    chunks as it fills, and writes the compressed chunks out to the
+    specified `DataFile` as it goes.  Only `jobs` chunks are ever held
+    in memory at once.  `chunks` will contain tuples of the uncompressed
+    and compressed size of each chunk written so far.
+
+    If `base` is passed in, it should be a `TMSArchive` for a previous
+    version of the archive.  Any chunk whose uncompressed data is unchanged
+    from the chunk at the same position in `base` will have its compressed
+    data copied over verbatim, rather than being recompressed.  `reused`
+    will contain the number of chunks copied over that way.
+
+    If `stats` is passed in, it should be a `Stats` object, which will be
+    updated with compression/write timings and the size of each chunk.
+    `level` and `strategy` are passed along to zlib.
+    """
+
+    def __init__(self, tms, chunksize, jobs=1, base=None, stats=None,
+            level=6, strategy=zlib.Z_DEFAULT_STRATEGY):
+        self.tms = tms
+        self.chunksize = chunksize
+        self.level = level
+        self.strategy = strategy
+        self.jobs = max(1, jobs)
+        self.chunks = []
+        self.total_comp_size = 0
+        self.total_uncomp_size = 0
+        self.buf = bytearray()
+        self.pending = []
+        self.base = base
+        self.base_df = None
+        self.reused = 0
+        self.stats = stats
+        if self.base is not None:
+            self.base_df = open(self.base.filename, 'rb')
+
+    def tell(self):
+        return self.total_uncomp_size
+
+    def write(self, d):
+        self.buf += d
+        self.total_uncomp_size += len(d)
+        while len(self.buf) >= self.chunksize:
+            self.pending.append(bytes(self.buf[:self.chunksize]))
+            del self.buf[:self.chunksize]
+            if len(self.pending) >= self.jobs:
+                self._flush()
+
+    def _base_chunk(self, chunk_idx, uncomp_offset, uncomp_size):
+        """
+        Returns the compressed data for the specified chunk from our base
+        archive, if it covers exactly the same span of uncompressed data
+        (or `None` otherwise).
+        """
+        if self.base is None or chunk_idx >= len(self.base.chunks):
+            return None
+        comp_offset, comp_size, base_uncomp_offset, base_uncomp_size = self.base.chunks[chunk_idx]
+        if base_uncomp_offset != uncomp_offset or base_uncomp_size != uncomp_size:
+            return None
+        self.base_df.seek(comp_offset)
+        return self.base_df.read(comp_size)
+
+    def _flush(self):
+        """
+        Compresses and writes out all of our pending chunks
+        """
+        base_chunks = []
+        uncomp_offset = len(self.chunks) * self.chunksize
+        for idx, span in enumerate(self.pending):
+            base_chunks.append(self._base_chunk(len(self.chunks) + idx, uncomp_offset, len(span)))
+            uncomp_offset += len(span)
+        with stats_phase(self.stats, 'compress', sum(len(span) for span in self.pending)):
+            compressed = compress_chunks(self.pending, self.jobs, base_chunks, self.level, self.strategy)
+        with stats_phase(self.stats, 'write', sum(len(c) for c in compressed)):
+            for span, base_chunk, chunk_data_comp in zip(self.pending, base_chunks, compressed):
+                if chunk_data_comp is base_chunk:
+                    self.reused += 1
+                self.tms.write(chunk_data_comp)
+                self.chunks.append((len(span), len(chunk_data_comp)))
+                self.total_comp_size += len(chunk_data_comp)
+                if self.stats is not None:
+                    self.stats.chunk(len(chunk_data_comp), len(span))
+        self.pending = []
+
+    def close(self):
+        """
+        Writes out whatever partial chunk we have left over
+        """
+        if self.buf:
+            self.pending.append(bytes(self.buf))
+            self.buf = bytearray()
+        self._flush()
+        if self.base_df is not None:
+            self.base_df.close()
+            self.base_df = None
+
+def get_file_labels(dirname, filelist, prefix):
+    """
+    Given a list of files inside `dirname`, returns a list of tuples
+    suitable for passing to `write_tms`: the local filename, the label
+    which the file will have inside the TMS file (with `prefix` prepended),
+    and the size of the file.
+    """
+    file_labels = []
+    strip_len = len(dirname)
+    for filename_local in filelist:
+        filename_label = prefix + filename_local[strip_len:]
+        if os.path.sep == '\\':
+            filename_label = filename_label.replace('\\', '/')
+        file_labels.append((filename_local, filename_label, os.path.getsize(filename_local)))
+    return file_labels
+
+def write_tms(filename, file_labels, chunksize=131072, magic=0x9E2A83C1,
+        footer_strs=(), footer_nums=(0, 0), jobs=1, base=None, verbose=False,
+        stats=None, level=6, strategy=zlib.Z_DEFAULT_STRATEGY):
+    """
+    Writes out a TMS file to `filename`.  `file_labels` should be a list of
+    tuples of the source of each file, its label inside the TMS file, and
+    its size.  The source may either be a local filename to read from, or
+    the file data itself (as a bytes-like object).  `jobs`, `base`,
+    `stats`, `level`, and `strategy` are passed along to `ChunkWriter`,
+    which is returned once the file has been written.  Raises a
+    `RuntimeError` if a local file changes size while we're packing.
+
+    The archive is written to a temporary file alongside `filename`, and
+    only moved into place once it's complete, so a failure partway through
+    leaves any existing file untouched (and `base` may be the same file as
+    `filename`).
+    """
+
+    # Figure out the total uncompressed size up front, so we know exactly
+    # how large the header and chunk table will be.
+    total_uncomp_size = 0
+    for _, filename_label, file_size in file_labels:
+        total_uncomp_size += 4 + len(filename_label.encode('utf-8')) + 1 + 4 + file_size
+    num_chunks = (total_uncomp_size + chunksize - 1) // chunksize
+
+    # Now start writing out the actual file, to a temp file until it's
+    # complete.  The header and chunk table get written as placeholders and
+    # then backpatched once we're done, since we don't know the compressed
+    # sizes until then.
+    temp_filename = f'{filename}.tmp{os.getpid()}'
+    tms = DataFile(filename=temp_filename)
+    try:
+        tms.write(b"\00" * (HEADER_SIZE + num_chunks*16))
+
+        # Stream our file data through the chunk compressor.  Source files
+        # are read in chunk-sized blocks, so we never hold more than a few
+        # chunks in memory.
+        chunk_writer = ChunkWriter(tms, chunksize, jobs, base, stats, level, strategy)
+        file_data = DataFile(df=chunk_writer)
+        for source, filename_label, file_size in file_labels:
+            if verbose:
+                print(f'   {filename_label}')
+            file_data.str(filename_label)
+            file_data.uint32(file_size)
+            if not isinstance(source, str):
+                assert(len(source) == file_size)
+                file_data.write(source)
+                continue
+            with open(source, 'rb') as df:
+                remaining = file_size
+                while remaining > 0:
+                    with stats_phase(stats, 'read') as phase:
+                        block = df.read(min(chunksize, remaining))
+                        phase['bytes'] = len(block)
+                    if not block:
+                        break
+                    file_data.write(block)
+                    remaining -= len(block)
+                if remaining > 0 or df.read(1):
+                    raise RuntimeError(f'{source} changed size while packing')
+        file_data.close()
+        assert(chunk_writer.total_uncomp_size == total_uncomp_size)
+        assert(len(chunk_writer.chunks) == num_chunks)
+
+        # Footer
+        with stats_phase(stats, 'footer') as phase:
+            footer_start = tms.tell()
+            tms.uint32(len(footer_strs))
+            for footer_str in footer_strs:
+                tms.str(footer_str)
+            tms.uint32(footer_nums[0])
+            tms.uint32(footer_nums[1])
+            phase['bytes'] = tms.tell() - footer_start
+
+        # Backpatch the header and chunk table
+        with stats_phase(stats, 'header', HEADER_SIZE + num_chunks*16):
+            tms.seek(0)
+            tms.uint32(total_uncomp_size)
+            tms.uint32(len(file_labels))
+            tms.ulong64(magic)
+            tms.ulong64(chunksize)
+            tms.ulong64(chunk_writer.total_comp_size)
+            tms.ulong64(total_uncomp_size)
+            for uncomp_size, comp_size in chunk_writer.chunks:
+                tms.ulong64(comp_size)
+                tms.ulong64(uncomp_size)
+
+        # ... and close!
+        tms.close()
+    except BaseException:
+        tms.close()
+        os.unlink(temp_filename)
+        raise
+    os.replace(temp_filename, filename)
+    return chunk_writer
+
+def tune_setting(file_labels, chunksize, level, strategy, samples=50, seed=0):
+    """
+    Packs the given files (see `write_tms`) into a temporary TMS file using
+    the given chunk size, zlib level, and strategy name, and returns a dict
+    describing the setting along with the time it took to pack, the size
+    of the resulting archive, and the average time it takes to read a
+    single random file out of it, starting from cold (with no chunks
+    already decompressed).
+    """
+    with tempfile.TemporaryDirectory(prefix='pack-oaktms-tune-') as tempdir:
+        filename = os.path.join(tempdir, 'tune.cfg')
+        start = time.perf_counter()
+        write_tms(filename, file_labels, chunksize=chunksize,
+                level=level, strategy=STRATEGIES[strategy])
+        pack_time = time.perf_counter() - start
+        size = os.path.getsize(filename)
+
+        tms = TMSArchive(filename, lazy=True)
+        names = list(tms.filenames())
+        rand = random.Random(seed)
+        picks = [rand.choice(names) for _ in range(samples)]
+        read_time = 0
+        for name in picks:
+            tms._chunk_cache.clear()
+            start = time.perf_counter()
+            tms.read(name)
+            read_time += time.perf_counter() - start
+
+    return {
+            'chunksize': chunksize,
+            'level': level,
+            'strategy': strategy,
+            'pack_time': pack_time,
+            'size': size,
+            'read_time': read_time / max(1, len(picks)),
+            }
+
+def pareto_front(results):
+    """
+    Returns the results (as returned by `tune_setting`) which are
+    Pareto-optimal with respect to archive size and single-file read time,
+    sorted by size.  That is, for every returned setting, no other setting
+    is both smaller and faster to read from.  Pack time is only used to
+    break ties.
+    """
+    front = []
+    for result in sorted(results, key=lambda r: (r['size'], r['read_time'], r['pack_time'])):
+        if not front or result['read_time'] < front[-1]['read_time']:
+            front.append(result)
+    return front
+
+def pick_balanced(front):
+    """
+    Picks a single "best" setting from the Pareto front: the one whose
+    size and read time, each relative to the best seen on the front, have
+    the lowest sum.
+    """
+    min_size = min(r['size'] for r in front)
+    min_read = min(r['read_time'] for r in front) or 1e-9
+    return min(front, key=lambda r: r['size']/min_size + r['read_time']/min_read)
+
+def tune(file_labels, chunksizes, levels, strategies, jobs=1, samples=50):
+    """
+    Packs the given files using every combination of the given chunk
+    sizes, zlib levels, and strategy names, running `jobs` settings at
+    once in a process pool.  Returns a list of results, as returned by
+    `tune_setting`.
+    """
+    settings = [(c, l, s) for c in chunksizes for l in levels for s in strategies]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [executor.submit(tune_setting, file_labels, c, l, s, samples)
+                for c, l, s in settings]
+        return [future.result() for future in futures]
+
+def print_tune_results(results, front, best):
+    """
+    Prints a table of tuning results, marking the Pareto-optimal settings
+    with `*` and the chosen setting with `>`
+    """
+    print(f'   {"chunksize":>9} {"level":>5} {"strategy":>8} {"pack (s)":>9} {"size":>10} {"read (ms)":>9}')
+    for result in sorted(results, key=lambda r: (r['size'], r['read_time'])):
+        if result is best:
+            mark = '>'
+        elif result in front:
+            mark = '*'
+        else:
+            mark = ' '
+        print(f'{mark}  {result["chunksize"]:>9} {result["level"]:>5} {result["strategy"]:>8} '
+                f'{result["pack_time"]:>9.3f} {result["size"]:>10} {result["read_time"]*1000:>9.3f}')
+
+def int_list(value):
+    """
+    Argument type for a comma-separated list of integers
+    """
+    return [int(v) for v in value.split(',')]
+
+def strategy_list(value):
+    """
+    Argument type for a comma-separated list of zlib strategy names
+    """
+    strategies = value.split(',')
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            raise argparse.ArgumentTypeError(f'unknown strategy: {strategy}')
+    return strategies
+
 def main():
 
     # Arguments!
@@ -128,6 +496,21 @@ def main():
             help='Chunk size to use in the TMS file',
             )
 
+    parser.add_argument('-l', '--level',
+            type=int,
+            default=6,
+            choices=range(0, 10),
+            metavar='LEVEL',
+            help='zlib compression level (0-9)',
+            )
+
+    parser.add_argument('--strategy',
+            type=str,
+            default='default',
+            choices=list(STRATEGIES.keys()),
+            help='zlib compression strategy',
+            )
+
     parser.add_argument('-p', '--prefix',
             type=str,
             default='../../..',
@@ -163,6 +546,17 @@ def main():
             help='Second "footer" number to add (purpose unknown)',
             )
 
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of threads to use while compressing',
+            )
+
+    parser.add_argument('-b', '--base',
+            type=str,
+            help='Previous version of the TMS file.  Compressed chunks whose data is unchanged will be copied from it rather than recompressed',
+            )
+
     parser.add_argument('-o', '--output',
             type=str,
             help='Output file (defaults to the name of the dir with `.cfg` appended)',
@@ -178,6 +572,49 @@ def main():
             help='Verbose output (just adds filename listing)',
             )
 
+    parser.add_argument('--stats',
+            type=str,
+            metavar='STATS_FILE',
+            help='Write JSON timing, throughput, and memory statistics for each phase of packing to STATS_FILE (or to stderr, if `-`, so it stays separate from the normal output)',
+            )
+
+    parser.add_argument('--tune',
+            action='store_true',
+            help='Rather than packing, try packing the directory with every combination of --tune-chunksizes, --tune-levels, and --tune-strategies (running --jobs of them at once), and report the pack time, archive size, and time to read a single random file for each.  Pareto-optimal settings are marked with `*`, and the best balance of size and read time with `>`',
+            )
+
+    parser.add_argument('--tune-chunksizes',
+            type=int_list,
+            default='32768,65536,131072,262144,524288',
+            metavar='SIZES',
+            help='Comma-separated chunk sizes to try while tuning',
+            )
+
+    parser.add_argument('--tune-levels',
+            type=int_list,
+            default='1,6,9',
+            metavar='LEVELS',
+            help='Comma-separated zlib levels to try while tuning',
+            )
+
+    parser.add_argument('--tune-strategies',
+            type=strategy_list,
+            default='default,filtered',
+            metavar='STRATEGIES',
+            help=f'Comma-separated zlib strategies to try while tuning (from: {", ".join(STRATEGIES.keys())})',
+            )
+
+    parser.add_argument('--tune-samples',
+            type=int,
+            default=50,
+            help='Number of random single-file reads to time for each setting while tuning',
+            )
+
+    parser.add_argument('--apply',
+            action='store_true',
+            help='With --tune, go on to pack the directory using the chosen setting',
+            )
+
     parser.add_argument('dirname',
             nargs=1,
             help='Directory to pack into OakTMS file (the directory name itself will not be included)',
@@ -210,10 +647,47 @@ def main():
         plural = ''
     else:
         plural = 's'
+
+    # Tune, if we've been told to
+    if args.tune:
+        print(f'Tuning with {len(filelist)} file{plural} from {args.dirname}')
+        results = tune(get_file_labels(args.dirname, filelist, args.prefix),
+                args.tune_chunksizes,
+                args.tune_levels,
+                args.tune_strategies,
+                jobs=args.jobs,
+                samples=args.tune_samples,
+                )
+        front = pareto_front(results)
+        best = pick_balanced(front)
+        print_tune_results(results, front, best)
+        print('')
+        print(f'Best balance: -c {best["chunksize"]} -l {best["level"]} --strategy {best["strategy"]}')
+        if not args.apply:
+            return
+        args.chunksize = best['chunksize']
+        args.level = best['level']
+        args.strategy = best['strategy']
+        print('')
+
     print(f'Compressing {len(filelist)} file{plural} to {args.output}')
 
-    # Check to see if the output file exists.  If so, delete it
-    # so long as the user has said to do so.
+    # Open up our base archive, if we have one.  We only need its header
+    # and chunk table, which is all that a streaming archive reads in
+    # until it's iterated over.
+    base = None
+    if args.base:
+        if not os.path.exists(args.base):
+            print(f'ERROR: {args.base} does not exist')
+            sys.exit(1)
+        base = TMSArchive(args.base, stream=True)
+        if base.chunk_size != args.chunksize:
+            print(f'WARNING: {args.base} uses a chunk size of {base.chunk_size}, so no chunks can be reused')
+
+    # Check to see if the output file exists.  If so, make sure the user
+    # is okay with overwriting it.  (It only gets replaced once the new
+    # archive has been completely written, which also means we can write
+    # on top of our base archive.)
     if os.path.exists(args.output):
         if not args.force:
             while True:
@@ -224,64 +698,37 @@ def main():
                     sys.exit(2)
                 elif resp == 'y':
                     break
-        os.unlink(args.output)
 
-    # Get our file data concatenated properly
-    file_data = DataFile(df=io.BytesIO())
-    strip_len = len(args.dirname)
-    for filename_local in filelist:
-        filename_label = args.prefix + filename_local[strip_len:]
-        if os.path.sep == '\\':
-            filename_label = filename_label.replace('\\', '/')
-        if args.verbose:
-            print(f'   {filename_label}')
-        with open(filename_local, 'rb') as df:
-            file_data.write_file(filename_label, df.read())
-    total_uncomp_size = file_data.tell()
-    file_data.seek(0)
-
-    # Split the file data into chunks and compress.  `chunks` contains tuples:
-    #   idx 0: uncompressed size
-    #   idx 1: compressed size
-    #   idx 2: compressed data
-    chunks = []
-    total_comp_size = 0
-    while file_data.tell() < total_uncomp_size:
-        to_read = min(args.chunksize, total_uncomp_size - file_data.tell())
-        chunk_data_comp = zlib.compress(file_data.read(to_read))
-        chunks.append((to_read, len(chunk_data_comp), chunk_data_comp))
-        total_comp_size += chunks[-1][1]
-
-    # Now start writing out the actual file
-    tms = DataFile(filename=args.output)
-
-    # Initial data
-    tms.uint32(total_uncomp_size)
-    tms.uint32(len(filelist))
-    tms.ulong64(args.magic)
-    tms.ulong64(args.chunksize)
-    tms.ulong64(total_comp_size)
-    tms.ulong64(total_uncomp_size)
-
-    # Chunk info, then chunks
-    for uncomp_size, comp_size, _ in chunks:
-        tms.ulong64(comp_size)
-        tms.ulong64(uncomp_size)
-    for _, _, chunk_data in chunks:
-        tms.write(chunk_data)
-    
-    # Footer
-    tms.uint32(3)
-    tms.str(args.date)
-    tms.str(args.footer1)
-    tms.str(args.footer2)
-    tms.uint32(args.footer_num1)
-    tms.uint32(args.footer_num2)
-
-    # ... and close!
-    tms.close()
-    file_data.close()
+    # Pack it all up
+    if args.stats:
+        stats = Stats('pack-oaktms')
+    else:
+        stats = None
+    file_labels = get_file_labels(args.dirname, filelist, args.prefix)
+    try:
+        chunk_writer = write_tms(args.output,
+                file_labels,
+                chunksize=args.chunksize,
+                magic=args.magic,
+                footer_strs=[args.date, args.footer1, args.footer2],
+                footer_nums=(args.footer_num1, args.footer_num2),
+                jobs=args.jobs,
+                base=base,
+                verbose=args.verbose,
+                stats=stats,
+                level=args.level,
+                strategy=STRATEGIES[args.strategy],
+                )
+    except RuntimeError as e:
+        print(f'ERROR: {e}')
+        sys.exit(1)
+
+    # ... and finish up!
+    if base is not None:
+        print(f'Reused {chunk_writer.reused} of {len(chunk_writer.chunks)} compressed chunks from {args.base}')
     print('Done!')
+    if stats is not None:
+        stats.write(args.stats)
 
 if __name__ == '__main__':
     main()
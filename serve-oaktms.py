@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+# Copyright 2022 Christopher J. Kucera
+# <cj@apocalyptech.com>
+# <http://apocalyptech.com/contact.php>
+#
+# PyOakTMS is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# PyOakTMS is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyOakTMS.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import stat
+import zlib
+import struct
+import argparse
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+
+from oaktms import TMSArchive
+from locres import LocRes
+
+class CachedArchive:
+    """
+    A fully-parsed archive held by an `ArchiveCache`, along with the
+    `LocRes` objects which have been parsed out of it so far.  `file_stat` is
+    the `os.stat()` result for the file, taken before it was parsed.
+    """
+
+    def __init__(self, filename, file_stat, jobs=1):
+        self.filename = filename
+        self.mtime = file_stat.st_mtime_ns
+        self.size = file_stat.st_size
+        self.archive = TMSArchive(filename, jobs=jobs)
+        self.names = list(self.archive.filenames())
+        self.cost = self.archive.total_uncomp_size
+        self._locres = {}
+        self._lock = threading.Lock()
+
+    def is_current(self, file_stat):
+        """
+        Returns `True` if the archive on disk is still the one we parsed
+        """
+        return (self.mtime, self.size) == (file_stat.st_mtime_ns, file_stat.st_size)
+
+    def listing(self, include=None):
+        """
+        Returns a list of dicts with the name and size of each file in the
+        archive (optionally restricted to the glob patterns in `include`)
+        """
+        return [{'name': self.names[idx], 'size': self.archive.lengths[idx]}
+                for idx in self.archive.select(include)]
+
+    def locres(self, filename):
+        """
+        Returns the parsed `LocRes` for the given `.locres` file inside the
+        archive, parsing it the first time it's asked for.  Raises a
+        `KeyError` if the file doesn't exist, or a `RuntimeError` if it's
+        not a valid .locres file.
+        """
+        with self._lock:
+            if filename not in self._locres:
+                try:
+                    self._locres[filename] = LocRes(self.archive.read(filename))
+                except RuntimeError as e:
+                    raise RuntimeError('{}: {}'.format(filename, e)) from e
+            return self._locres[filename]
+
+    def locres_lookup(self, namespace, key, include=None):
+        """
+        Returns a dict mapping the name of each `.locres` file in the archive
+        (optionally restricted to the glob patterns in `include`) which has
+        the given namespace and key, to its string.
+        """
+        locres_files = set(self.archive.select(['*.locres']))
+        if include:
+            locres_files &= set(self.archive.select(include))
+        found = {}
+        for idx in sorted(locres_files):
+            try:
+                found[self.names[idx]] = self.locres(self.names[idx]).get(namespace, key)
+            except KeyError:
+                pass
+        return found
+
+class ArchiveCache:
+    """
+    Keeps recently-used archives parsed in memory, evicting the least
+    recently used ones once their total decompressed size goes over
+    `max_bytes`.  (The most recently used archive is always kept, even if
+    it's bigger than that on its own.)  Archives are re-parsed whenever
+    their mtime or size on disk changes.
+
+    Lookups are thread-safe.  Parsing one archive only holds up requests
+    for that same archive; everything else keeps getting served meanwhile.
+    """
+
+    def __init__(self, max_bytes, jobs=1, verbose=False):
+        self.max_bytes = max_bytes
+        self.jobs = jobs
+        self.verbose = verbose
+        self.archives = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def _log(self, message):
+        if self.verbose:
+            print(message, file=sys.stderr)
+
+    def _drop(self, filename):
+        """
+        Removes the given archive from the cache.  Must be called with our
+        lock held.  Requests which are already using it can carry on, since
+        nothing gets closed.
+        """
+        cached = self.archives.pop(filename, None)
+        if cached is not None:
+            self.total_bytes -= cached.cost
+
+    def get(self, filename):
+        """
+        Returns the `CachedArchive` for `filename`, parsing it (and evicting
+        others to make room) if it's not already cached and current.
+        """
+        with self._lock:
+            load_lock = self._load_locks.setdefault(filename, threading.Lock())
+        with load_lock:
+            try:
+                file_stat = os.stat(filename)
+            except OSError:
+                with self._lock:
+                    self._drop(filename)
+                raise
+            with self._lock:
+                cached = self.archives.get(filename)
+                if cached is not None:
+                    if cached.is_current(file_stat):
+                        self.archives.move_to_end(filename)
+                        self.hits += 1
+                        return cached
+                    self._log('{} changed on disk, reloading'.format(filename))
+                    self._drop(filename)
+                self.misses += 1
+
+            cached = CachedArchive(filename, file_stat, jobs=self.jobs)
+            self._log('Loaded {} ({} files, {} bytes)'.format(filename, len(cached.names), cached.cost))
+
+            with self._lock:
+                self.archives[filename] = cached
+                self.total_bytes += cached.cost
+                while self.total_bytes > self.max_bytes and len(self.archives) > 1:
+                    evicted = next(iter(self.archives))
+                    self._drop(evicted)
+                    self.evictions += 1
+                    self._log('Evicted {}'.format(evicted))
+            return cached
+
+    def status(self):
+        """
+        Returns a dict describing what's in the cache, for reporting
+        """
+        with self._lock:
+            return {
+                    'archives': list(self.archives),
+                    'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    }
+
+class ArchiveRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves requests for the archives in `server.archives` (a dict mapping
+    the names they're served under to their filenames), via `server.cache`
+    (an `ArchiveCache`):
+
+        GET /                   JSON list of archive names
+        GET /ARCHIVE            JSON list of files (name and size)
+        GET /ARCHIVE/FILE       Raw contents of FILE
+        GET /ARCHIVE/FILE?namespace=NS&key=KEY
+                                String for NS/KEY in .locres FILE
+        GET /ARCHIVE?namespace=NS&key=KEY
+                                JSON of the string for NS/KEY in every
+                                .locres file which has it
+
+    Archive listings and lookups may be restricted with one or more
+    `include=PATTERN` parameters.  `GET /?status` reports on the cache.
+    """
+
+    server_version = 'serve-oaktms'
+
+    def address_string(self):
+        # Unix-socket clients don't have an address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, value, status=200):
+        self._send(status, 'application/json', json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def _send_error(self, status, message):
+        self._send_json({'error': message}, status)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        archive_name, _, entry = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        include = query.get('include')
+        if ('namespace' in query) != ('key' in query):
+            self._send_error(400, 'namespace and key must be given together')
+            return
+
+        if not archive_name:
+            if 'status' in query:
+                self._send_json(self.server.cache.status())
+            else:
+                self._send_json(sorted(self.server.archives))
+            return
+        if archive_name not in self.server.archives:
+            self._send_error(404, 'Archive "{}" not found'.format(archive_name))
+            return
+
+        try:
+            cached = self.server.cache.get(self.server.archives[archive_name])
+            if 'namespace' in query:
+                namespace = query['namespace'][0]
+                key = query['key'][0]
+                if entry and not entry.endswith('.locres'):
+                    self._send_error(400, '"{}" is not a .locres file'.format(entry))
+                elif entry:
+                    text = cached.locres(entry).get(namespace, key)
+                    self._send(200, 'text/plain; charset=utf-8', text.encode('utf-8'))
+                else:
+                    self._send_json(cached.locres_lookup(namespace, key, include))
+            elif entry:
+                self._send(200, 'application/octet-stream', cached.archive.read(entry))
+            else:
+                self._send_json(cached.listing(include))
+        except KeyError:
+            self._send_error(404, 'Not found')
+        except (RuntimeError, AssertionError, OSError, zlib.error, ValueError, IndexError, struct.error) as e:
+            # Corrupt archives, or .locres files we can't parse
+            self._send_error(500, '{}: {}'.format(type(e).__name__, e))
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP served over a unix socket, one thread per connection
+    """
+    daemon_threads = True
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            description='Serve OakTMS/DaffodilTMS archive contents and .locres lookups over HTTP',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            )
+    parser.add_argument('-b', '--bind',
+            type=str,
+            default='127.0.0.1',
+            help='Address to listen on',
+            )
+    parser.add_argument('-p', '--port',
+            type=int,
+            default=8000,
+            help='Port to listen on',
+            )
+    parser.add_argument('-u', '--socket',
+            type=str,
+            metavar='PATH',
+            help='Listen on a unix socket at PATH, instead of a TCP port',
+            )
+    parser.add_argument('-c', '--cache-size',
+            type=int,
+            default=1024,
+            metavar='MB',
+            help='Maximum total decompressed size of archives to keep parsed in memory, in megabytes',
+            )
+    parser.add_argument('-j', '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of threads to use while decompressing',
+            )
+    parser.add_argument('-v', '--verbose',
+            action='store_true',
+            help='Log requests and cache activity to stderr',
+            )
+    parser.add_argument('filename',
+            nargs='+',
+            help='Archives to serve, under their base filenames',
+            )
+    args = parser.parse_args()
+
+    archives = {}
+    for filename in args.filename:
+        name = os.path.basename(filename)
+        if name in archives:
+            parser.error('more than one archive named "{}"'.format(name))
+        if not os.path.isfile(filename):
+            print('ERROR: {} is not a file'.format(filename))
+            sys.exit(1)
+        archives[name] = os.path.abspath(filename)
+
+    if args.socket:
+        # Clear out a stale socket from a previous run, but nothing else
+        if os.path.lexists(args.socket):
+            if not stat.S_ISSOCK(os.lstat(args.socket).st_mode):
+                print('ERROR: {} exists and is not a socket'.format(args.socket))
+                sys.exit(1)
+            os.unlink(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, ArchiveRequestHandler)
+        address = args.socket
+    else:
+        server = http.server.ThreadingHTTPServer((args.bind, args.port), ArchiveRequestHandler)
+        address = 'http://{}:{}/'.format(*server.server_address[:2])
+    server.archives = archives
+    server.cache = ArchiveCache(args.cache_size*1024*1024, jobs=args.jobs, verbose=args.verbose)
+    server.verbose = args.verbose
+
+    print('Serving {} archive(s) on {}'.format(len(archives), address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)